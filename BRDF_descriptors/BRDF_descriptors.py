@@ -26,11 +26,21 @@ kernels have been used.
 
 import datetime
 import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from pathlib import Path
 
 import numpy as np
 import gdal
 
+from .instrument import PROBES, record
+
 __author__ = "J Gomez-Dans"
 __copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
 __license__ = "GPLv3"
@@ -49,20 +59,211 @@ GDAL2NUMPY = {gdal.GDT_Byte:   np.uint8,
               gdal.GDT_CFloat64:   np.complex128
               }
 
-def find_granules(dire, tile, product, start_time, end_time):
+GRANULE_INDEX_NAME = ".mcd43_granule_index.sqlite"
+
+GRANULE_REGEX = re.compile(
+    r"^MCD43(?P<product>A[12])\.A(?P<date>\d{7})\.(?P<tile>h\d{2}v\d{2})\..*\.hdf$")
+
+
+class GranuleIndex(object):
+    """A persistent index of the MCD43 granules stored under a folder.
+
+    The index lives in an SQLite file (by default `GRANULE_INDEX_NAME`
+    at the top of the archive) and stores every granule keyed by
+    product, tile and date. Each indexed directory is stored together
+    with its modification time, so that `update` only lists the
+    directories that have changed since the last scan. If `read_only`
+    is True, the index is only opened for queries (e.g. for an index
+    shared on read-only storage). An index can also be opened for any
+    folder below the one it was built for, and its queries are then
+    restricted to that folder."""
+
+    def __init__(self, dire, index_file=None, read_only=False):
+        self.dire = Path(dire).absolute()
+        if index_file is None:
+            index_file = self.dire / GRANULE_INDEX_NAME
+        self.index_file = Path(index_file)
+        if read_only:
+            self.db = sqlite3.connect(
+                self.index_file.absolute().as_uri() + "?mode=ro",
+                uri=True, check_same_thread=False)
+            return
+        self.db = sqlite3.connect(self.index_file.as_posix(),
+                                  check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS directories (" +
+                            "path TEXT PRIMARY KEY, mtime INTEGER, " +
+                            "subdirs TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS granules (" +
+                            "product TEXT, tile TEXT, date TEXT, " +
+                            "directory TEXT, path TEXT PRIMARY KEY)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS granule_lookup " +
+                            "ON granules (product, tile, date)")
+
+    @classmethod
+    def exists(cls, dire, index_file=None):
+        """Returns True if an index has been built for `dire`."""
+        if index_file is None:
+            index_file = Path(dire) / GRANULE_INDEX_NAME
+        return os.path.exists(index_file)
+
+    def close(self):
+        self.db.close()
+
+    def covers(self):
+        """Returns True if the folder has been indexed."""
+        return self.db.execute("SELECT 1 FROM directories WHERE path=?",
+                               (self.dire.as_posix(),)).fetchone() \
+            is not None
+
+    def update(self):
+        """Incrementally updates the index. Directories whose mtime
+        hasn't changed are not listed again, only the directories below
+        them are visited. Returns the number of directories that
+        were (re)scanned."""
+        known = {path: (mtime, subdirs) for path, mtime, subdirs in
+                 self.db.execute("SELECT * FROM directories")}
+        visited = set()
+        n_scanned = 0
+        pending = [self.dire.as_posix()]
+        with self.db:
+            while pending:
+                dire = pending.pop()
+                if dire in visited:
+                    continue
+                # Unreadable directories are skipped (and forgotten)
+                try:
+                    mtime = os.stat(dire).st_mtime_ns
+                    if dire in known and known[dire][0] == mtime:
+                        subdirs = [d for d in known[dire][1].split("\n")
+                                   if d]
+                    else:
+                        subdirs = self._scan_directory(dire, mtime)
+                        n_scanned += 1
+                except OSError:
+                    continue
+                visited.add(dire)
+                pending.extend(subdirs)
+            # Forget about directories that have disappeared
+            for dire in set(known) - visited:
+                self.db.execute("DELETE FROM directories WHERE path=?",
+                                (dire,))
+                self.db.execute("DELETE FROM granules WHERE directory=?",
+                                (dire,))
+        return n_scanned
+
+    def _scan_directory(self, dire, mtime):
+        subdirs = []
+        granules = []
+        with os.scandir(dire) as entries:
+            for entry in entries:
+                # Like `Path.rglob`, symlinks to directories aren't
+                # followed
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                match = GRANULE_REGEX.match(entry.name)
+                if match is None:
+                    continue
+                timex = datetime.datetime.strptime(match.group("date"),
+                                                   "%Y%j")
+                granules.append((match.group("product"),
+                                 match.group("tile"),
+                                 timex.strftime("%Y-%m-%d"), dire,
+                                 Path(entry.path).as_posix()))
+        self.db.execute("DELETE FROM granules WHERE directory=?", (dire,))
+        self.db.executemany("INSERT OR REPLACE INTO granules " +
+                            "VALUES (?, ?, ?, ?, ?)", granules)
+        self.db.execute("INSERT OR REPLACE INTO directories VALUES " +
+                        "(?, ?, ?)", (dire, mtime, "\n".join(subdirs)))
+        return subdirs
+
+    def query(self, tile, product, start_time, end_time=None):
+        """Returns a dictionary of datetimes and granules for a given
+        tile and product (A1 or A2) between `start_time` and `end_time`
+        (both inclusive)."""
+        dire = self.dire.as_posix()
+        sql = "SELECT date, path FROM granules WHERE product=? AND " + \
+            "tile=? AND date>=? AND (directory=? OR " + \
+            "substr(directory, 1, ?)=?)"
+        args = [product, tile, start_time.strftime("%Y-%m-%d"), dire,
+                len(dire) + 1, dire + "/"]
+        if end_time is not None:
+            sql += " AND date<=?"
+            args.append(end_time.strftime("%Y-%m-%d"))
+        return {datetime.datetime.strptime(date, "%Y-%m-%d"): path
+                for date, path in self.db.execute(sql, args)}
+
+
+def build_granule_index(dire, index_file=None):
+    """Builds (or updates) the granule index for `dire`, so that
+    subsequent calls to `find_granules` can use it."""
+    index = GranuleIndex(dire, index_file=index_file)
+    try:
+        index.update()
+    finally:
+        index.close()
+    return index.index_file
+
+
+# GDAL subdataset name of a (granule, layer). Can be changed to read
+# granules converted to other formats, e.g. 'NETCDF:"%s":%s'.
+SUBDATASET_TEMPLATE = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_BRDF:%s'
+
+KERNEL_SCALE = 0.001
+KERNEL_FILL = 32767
+QA_FILL = 255
+LAND_TYPES = [1, 3, 4, 5]
+
+# Bits of the per-pixel flags returned by `pack_flags`. The QA class
+# (0 to 4, or 7 for fill) is stored in bits 3 to 5.
+FLAG_SNOW_FREE = 1
+FLAG_LAND = 2
+FLAG_FILL = 4
+FLAG_QA_SHIFT = 3
+FLAG_QA_BITS = 7 << FLAG_QA_SHIFT
+
+
+def find_granules(dire, tile, product, start_time, end_time,
+                  use_index=True, index_file=None):
     """Find MCD43 granules based on folder, tile and product type (A1
     or A2). Returns a dictionary of datetimes of the products and
-    granules, or raises an IOError exception if not files found."""
+    granules, or raises an IOError exception if not files found.
+    If `end_time` is None, all the granules from `start_time` on are
+    returned. If a granule index covering `dire` has been built (see
+    `build_granule_index`), either in `dire` or in `index_file` (e.g.
+    for an archive on read-only storage), it is queried instead of
+    scanning the folder. The index isn't updated here, so
+    `build_granule_index` has to be called again when granules are
+    added to the archive."""
+    t0 = time.perf_counter() if PROBES else None
+    granules = None
+    if use_index and GranuleIndex.exists(dire, index_file=index_file):
+        index = GranuleIndex(dire, index_file=index_file, read_only=True)
+        try:
+            if index.covers():
+                granules = index.query(tile, product, start_time,
+                                       end_time)
+        finally:
+            index.close()
+    if granules is not None:
+        if len(granules) == 0:
+            raise IOError("Couldn't find any MCD43%s files in %s" %
+                          (product, dire))
+        if t0 is not None:
+            record("scan", t0)
+        return granules
     times = []
     fnames = []
     path = Path(dire)
-    start_year = start_time.year
-    end_year = end_time.year
-    granules_start = path.rglob(f"**/MCD43{product:s}.A{start_year:4d}*.{tile:s}.*.hdf")
-    granules = [f  for f in granules_start] 
-    if end_year != start_year:
-        granules_end = path.rglob(f"**/MCD43{product:s}.A{end_year:4d}*.{tile:s}.*.hdf")
-        granules = granules + [f for f in granules_end] 
+    if end_time is None:
+        years = [""]
+    else:
+        years = ["%4d" % year
+                 for year in range(start_time.year, end_time.year + 1)]
+    granules = []
+    for year in years:
+        granules += path.rglob(f"**/MCD43{product:s}.A{year:s}*.{tile:s}.*.hdf")
     granules = list(set(granules))
     if len(granules) == 0:
         raise IOError("Couldn't find any MCD43%s files in %s" % (product, dire))
@@ -73,6 +274,8 @@ def find_granules(dire, tile, product, start_time, end_time):
             (end_time is None or timex <= end_time ):
             times.append (timex)
             fnames.append(granule.as_posix())
+    if t0 is not None:
+        record("scan", t0)
     return dict(list(zip(times, fnames)))
 
 
@@ -99,10 +302,74 @@ def process_time_input(timestamp):
     return output_time
 
 
-def open_gdal_dataset(fname, roi=None):
-    g = gdal.Open(fname)
+class DatasetPool(object):
+    """A pool of open GDAL datasets, so that reading several windows
+    from the same subdataset doesn't require opening it (and parsing
+    its HDF metadata) again. GDAL datasets can't be shared between
+    threads, so each thread keeps its own set of at most `max_open`
+    handles, closing the least recently used ones first."""
+
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.opens = 0
+        self.opens_avoided = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _handles(self):
+        try:
+            return self._local.handles
+        except AttributeError:
+            self._local.handles = OrderedDict()
+            return self._local.handles
+
+    def open(self, fname):
+        """Returns an open GDAL dataset for `fname`, reusing one of
+        this thread's handles if possible."""
+        handles = self._handles()
+        g = handles.get(fname)
+        if g is not None:
+            handles.move_to_end(fname)
+            with self._lock:
+                self.opens_avoided += 1
+            return g
+        t0 = time.perf_counter() if PROBES else None
+        g = gdal.Open(fname)
+        if t0 is not None:
+            record("open", t0, layer=fname)
+        if g is None:
+            raise IOError("Can't open %s" % fname)
+        with self._lock:
+            self.opens += 1
+        handles[fname] = g
+        while len(handles) > self.max_open:
+            handles.popitem(last=False)
+        return g
+
+    def clear(self):
+        """Closes the handles held by the calling thread."""
+        self._handles().clear()
+
+    def stats(self):
+        """Returns a dictionary with the number of opens done and
+        avoided."""
+        with self._lock:
+            return {"opens": self.opens,
+                    "opens_avoided": self.opens_avoided,
+                    "max_open": self.max_open}
+
+
+def open_gdal_dataset(fname, roi=None, pool=None):
+    if pool is not None:
+        g = pool.open(fname)
+    else:
+        t0 = time.perf_counter() if PROBES else None
+        g = gdal.Open(fname)
+        if t0 is not None:
+            record("open", t0, layer=fname)
     if g is None:
         raise IOError("Can't open %s" % fname)
+    t0 = time.perf_counter() if PROBES else None
     if roi is None:
         data = g.ReadAsArray()
     else:
@@ -112,80 +379,551 @@ def open_gdal_dataset(fname, roi=None):
         xcount = lrx - ulx
         ycount = lry - uly
         data = g.ReadAsArray(xoff, yoff, xcount, ycount).astype(
-                             GDAL2NUMPY[g.GetRasterBand(1).DataType])
+                             GDAL2NUMPY[g.GetRasterBand(1).DataType],
+                             copy=False)
+    if t0 is not None:
+        record("read", t0, nbytes=data.nbytes, n_arrays=1, layer=fname)
     return data
 
 
-def process_masked_kernels(band_no, a1_granule, a2_granule,
-                           band_transfer=None, roi=None):
-    if band_transfer is not None:
-        band_no = band_transfer[band_no]
+class LayerCache(object):
+    """A bounded, thread-safe, in-memory LRU cache of processed layers.
+
+    Layers are keyed by (granule, layer, roi), and the least recently
+    used layers are evicted once the cached arrays take up more than
+    `max_bytes`. Cached arrays are read-only, as they are shared by
+    all the users of the cache. Layers read through `fetch` are only
+    read once, even when several threads ask for them at once."""
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._layers = OrderedDict()
+        self._reading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._layers)
+
+    def get(self, key):
+        """Returns the cached array for `key`, or None."""
+        with self._lock:
+            try:
+                data = self._layers[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._layers.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def fetch(self, key, read):
+        """Returns the cached array for `key`, or reads it by calling
+        `read()` and caches it. If another thread is already reading
+        `key`, waits for that read instead of reading it again."""
+        with self._lock:
+            data = self._layers.get(key)
+            if data is not None:
+                self._layers.move_to_end(key)
+                self.hits += 1
+                return data
+            future = self._reading.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                self._reading[key] = reading = Future()
+        if future is not None:
+            return future.result()
+        try:
+            data = read()
+            data.setflags(write=False)
+            self.put(key, data)
+        except BaseException as e:
+            reading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._reading[key]
+        reading.set_result(data)
+        return data
+
+    def put(self, key, data):
+        """Stores `data` under `key`, evicting old layers if needed.
+        Arrays larger than the cache itself are not stored."""
+        if data.nbytes > self.max_bytes:
+            return
+        data.setflags(write=False)
+        with self._lock:
+            if key in self._layers:
+                self.nbytes -= self._layers.pop(key).nbytes
+            self._layers[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._layers.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._layers.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Returns a dictionary with the cache hit/miss statistics."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced,
+                    "evictions": self.evictions,
+                    "layers": len(self._layers), "nbytes": self.nbytes,
+                    "max_bytes": self.max_bytes}
+
+
+def granule_layer(granule, layer):
+    """Returns the GDAL subdataset name of a layer in a MCD43 granule,
+    following `SUBDATASET_TEMPLATE`."""
+    return SUBDATASET_TEMPLATE % (granule, layer)
+
+
+def read_layer(granule, layer, roi=None, process=None, cache=None,
+               pool=None, dtype=None):
+    """Reads a layer from a granule, optionally passing it through a
+    `process` function (e.g. `process_kernels`, called with `dtype` if
+    given). If a `LayerCache` is given, the processed layer is looked up
+    in (and stored to) it, with concurrent reads of the same layer done
+    only once, and if a `DatasetPool` is given, the dataset is opened
+    through it."""
+    def read():
+        data = open_gdal_dataset(granule_layer(granule, layer), roi,
+                                 pool=pool)
+        if process is not None:
+            data = process(data) if dtype is None \
+                else process(data, dtype=dtype)
+        return data
+
+    if cache is None:
+        return read()
+    key = (granule, layer, None if roi is None else tuple(roi),
+           None if process is None else process.__name__,
+           None if dtype is None else np.dtype(dtype).str)
+    return cache.fetch(key, read)
+
 
-    fname_a1 = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_BRDF:' % (a1_granule)
-    fname_a2 = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_BRDF:' % (a2_granule)
+def band_layers(band_no, a1_granule, a2_granule):
+    """Returns the (granule, layer) pairs of the kernels and QA layers
+    for a band. Bands can be given either as numbers (1 to 7), or as
+    strings for the broadband products (e.g. "vis", "nir" or
+    "shortwave")."""
     try:
-        fdata = fname_a1 + 'BRDF_Albedo_Parameters_Band%d' % (band_no)
+        fdata = (a1_granule, 'BRDF_Albedo_Parameters_Band%d' % (band_no))
     except TypeError:
-        fdata = fname_a1 + 'BRDF_Albedo_Parameters_%s' % (band_no)
-
-    fsnow = fname_a2 + 'Snow_BRDF_Albedo'
-    fland = fname_a2 + 'BRDF_Albedo_LandWaterType'
-    func = fname_a2 + 'BRDF_Albedo_Uncertainty'   # % a2_granule
+        fdata = (a1_granule, 'BRDF_Albedo_Parameters_%s' % (band_no))
     try:
-        fqa = fname_a2 + 'BRDF_Albedo_Band_Quality_Band%d' % band_no
+        fqa = (a2_granule, 'BRDF_Albedo_Band_Quality_Band%d' % band_no)
     except TypeError:
-        fqa = fname_a1 + 'BRDF_Albedo_Band_Mandatory_Quality_%s' % band_no
-
-    for fname in [fdata, fsnow, fland, fqa]:
-        data = open_gdal_dataset(fname, roi)
-        if fname.find("Albedo_Parameters") >= 0:
-            # Read kernels, post process
-            kernels = process_kernels(data)
-        elif fname.find("Snow") >= 0:
-            # Read snow mask... post process
-            snow = process_snow(data)
-        elif fname.find("XXXXXLandWaterType") >= 0:
-            shp = data.shape
-            land = np.in1d(data, [1, 3, 4, 5])    # data == 1 # Only land
-            land = land.reshape(shp)
-
-        # elif fname.find("BRDF_Albedo_Uncertainty") >= 0:
-        #    unc = process_unc (data)
-        elif fname.find("BRDF_Albedo_Band_Quality") >= 0 or \
-                fname.find("BRDF_Albedo_Band_Mandatory_Quality") >= 0:
-            qa = np.where(data <= 1, True, False)   # Best & good
-            qa_val = data*1
+        fqa = (a1_granule,
+               'BRDF_Albedo_Band_Mandatory_Quality_%s' % band_no)
+    return fdata, fqa
+
 
+def process_band(band_no, a1_granule, a2_granule, snow, roi=None,
+                 out=None, cache=None, pool=None, dtype=np.float32,
+                 raw=False):
+    """Reads and processes the kernels and QA for a single band, given
+    an already processed snow mask. Kernels and QA are returned as
+    `dtype` arrays, or if `raw` is True, the kernels are returned as the
+    int16 values stored in the file (to be multiplied by
+    `KERNEL_SCALE`, with `KERNEL_FILL` as fill value). If `out` is
+    given, it must be a tuple of (kernels, mask, qa) arrays of the right
+    shape, and the results are written into them. Layers are read
+    through `cache` and `pool` if they are given."""
+    fdata, fqa = band_layers(band_no, a1_granule, a2_granule)
+    kernels, mask, qa_val = (None, None, None) if out is None else out
+    if raw:
+        data = read_layer(*fdata, roi=roi, cache=cache, pool=pool)
+        if kernels is not None:
+            np.copyto(kernels, data)
+        else:
+            kernels = data if cache is None else data.copy()
+    elif cache is None:
+        kernels = process_kernels(open_gdal_dataset(granule_layer(*fdata),
+                                                    roi, pool=pool),
+                                  out=kernels, dtype=dtype)
+    else:
+        data = read_layer(*fdata, roi=roi, process=process_kernels,
+                          cache=cache, pool=pool, dtype=dtype)
+        if kernels is not None:
+            np.copyto(kernels, data)
+        else:
+            kernels = data.copy()
+    data = read_layer(*fqa, roi=roi, cache=cache, pool=pool)
+    t0 = time.perf_counter() if PROBES else None
+    n_arrays = 0
+    if mask is None:
+        mask = np.empty(data.shape, dtype=bool)
+        qa_val = np.empty(data.shape, dtype=dtype)
+        n_arrays = 2
     # Create mask:
     # 1. Ignore snow
     # 2. Only land
     # 3. Only good and best
-    mask = snow * qa   # *land * qa
-    qa_val = np.where(mask, qa_val, np.nan)
+    np.less_equal(data, 1, out=mask)   # Best & good
+    np.logical_and(mask, snow, out=mask)   # *land
+    qa_val.fill(np.nan)
+    np.copyto(qa_val, data, where=mask)
+    if t0 is not None:
+        record("mask", t0, nbytes=mask.nbytes + qa_val.nbytes,
+               n_arrays=n_arrays)
     return kernels, mask, qa_val
 
 
-def process_unc(unc):
-    """Process uncertainty. Fuck know what it means..."""
-    unc = np.where(unc == 32767, np.nan, unc/1000.)
+def process_masked_kernels(band_no, a1_granule, a2_granule,
+                           band_transfer=None, roi=None, out=None,
+                           cache=None, pool=None, dtype=np.float32,
+                           raw=False):
+    if band_transfer is not None:
+        band_no = band_transfer[band_no]
+    snow = read_layer(a2_granule, 'Snow_BRDF_Albedo', roi=roi,
+                      process=process_snow, cache=cache, pool=pool)
+    return process_band(band_no, a1_granule, a2_granule, snow, roi=roi,
+                        out=out, cache=cache, pool=pool, dtype=dtype,
+                        raw=raw)
+
+
+def process_masked_kernels_multiband(bands, a1_granule, a2_granule,
+                                     band_transfer=None, roi=None,
+                                     cache=None, pool=None,
+                                     dtype=np.float32, raw=False):
+    """Processes several bands from the same pair of granules. The
+    layers shared by all bands (the snow mask) are only read once.
+    Returns a (band, 3, y, x) kernels array, and (band, y, x) mask and
+    QA arrays."""
+    if band_transfer is not None:
+        bands = [band_transfer[band_no] for band_no in bands]
+    snow = read_layer(a2_granule, 'Snow_BRDF_Albedo', roi=roi,
+                      process=process_snow, cache=cache, pool=pool)
+    kernels = None
+    for i, band_no in enumerate(bands):
+        if kernels is None:
+            band_kernels, band_mask, band_qa = process_band(
+                band_no, a1_granule, a2_granule, snow, roi=roi,
+                cache=cache, pool=pool, dtype=dtype, raw=raw)
+            kernels = np.empty((len(bands),) + band_kernels.shape,
+                               dtype=band_kernels.dtype)
+            mask = np.empty((len(bands),) + band_mask.shape,
+                            dtype=band_mask.dtype)
+            qa = np.empty((len(bands),) + band_qa.shape,
+                          dtype=band_qa.dtype)
+            kernels[i] = band_kernels
+            mask[i] = band_mask
+            qa[i] = band_qa
+        else:
+            process_band(band_no, a1_granule, a2_granule, snow, roi=roi,
+                         out=(kernels[i], mask[i], qa[i]), cache=cache,
+                         pool=pool, dtype=dtype, raw=raw)
+    return kernels, mask, qa
+
+
+def tile_blocks(fname, roi=None, block_size=512):
+    """Splits the extent of a subdataset (or the `roi` within it) into
+    blocks of roughly `block_size` x `block_size` pixels. The block
+    size is rounded up to a multiple of the native chunk size of the
+    dataset, so that each chunk is only read by a single block. Returns
+    a list of (ulx, uly, lrx, lry) blocks."""
+    g = gdal.Open(fname)
+    if g is None:
+        raise IOError("Can't open %s" % fname)
+    chunk_x, chunk_y = g.GetRasterBand(1).GetBlockSize()
+    if roi is None:
+        roi = (0, 0, g.RasterXSize, g.RasterYSize)
+    ulx, uly, lrx, lry = roi
+    step_x = chunk_x * max(1, -(-block_size // chunk_x))
+    step_y = chunk_y * max(1, -(-block_size // chunk_y))
+    blocks = []
+    for y0 in range(uly - uly % step_y, lry, step_y):
+        for x0 in range(ulx - ulx % step_x, lrx, step_x):
+            blocks.append((max(x0, ulx), max(y0, uly),
+                           min(x0 + step_x, lrx), min(y0 + step_y, lry)))
+    return blocks
+
+
+def _process_block(band_no, a1_granule, a2_granule, band_transfer, block,
+                   dtype):
+    kernels, mask, qa = process_masked_kernels(band_no, a1_granule,
+                                               a2_granule,
+                                               band_transfer=band_transfer,
+                                               roi=block, dtype=dtype)
+    return block, kernels, mask, qa
+
+
+def process_masked_kernels_tiled(band_no, a1_granule, a2_granule,
+                                 band_transfer=None, roi=None,
+                                 block_size=512, n_workers=None,
+                                 dtype=np.float32):
+    """Processes a band like `process_masked_kernels`, but splitting the
+    tile (or `roi`) into blocks aligned with the chunks of the HDF file
+    (see `tile_blocks`), which are read, scaled and masked in parallel by
+    a pool of `n_workers` processes. The blocks are then assembled into
+    the output arrays, so the memory used by each worker scales with the
+    block size rather than the tile size."""
+    band = band_no if band_transfer is None else band_transfer[band_no]
+    fdata, _ = band_layers(band, a1_granule, a2_granule)
+    blocks = tile_blocks(granule_layer(*fdata), roi=roi,
+                         block_size=block_size)
+    x0 = min(block[0] for block in blocks)
+    y0 = min(block[1] for block in blocks)
+    nx = max(block[2] for block in blocks) - x0
+    ny = max(block[3] for block in blocks) - y0
+    kernels = np.empty((3, ny, nx), dtype=dtype)
+    mask = np.empty((ny, nx), dtype=bool)
+    qa = np.empty((ny, nx), dtype=dtype)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = set(executor.submit(_process_block, band_no,
+                                      a1_granule, a2_granule,
+                                      band_transfer, block, dtype)
+                      for block in blocks)
+        # Blocks are copied and dropped as soon as they are ready
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                (ulx, uly, lrx, lry), block_kernels, block_mask, \
+                    block_qa = future.result()
+                window = (slice(uly - y0, lry - y0),
+                          slice(ulx - x0, lrx - x0))
+                kernels[(slice(None),) + window] = block_kernels
+                mask[window] = block_mask
+                qa[window] = block_qa
+    return kernels, mask, qa
+
+
+def group_pixels(rows, cols, window_size=64):
+    """Groups pixel locations into windows, so that nearby pixels can be
+    read together. Pixels are binned into a grid of `window_size`
+    cells, and each window is the bounding box of the pixels in a cell.
+    Returns a list of ((ulx, uly, lrx, lry), indices) tuples."""
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    cells = (rows // window_size) * (cols.max() // window_size + 1) + \
+        cols // window_size
+    windows = []
+    for cell in np.unique(cells):
+        indices = np.nonzero(cells == cell)[0]
+        roi = (cols[indices].min(), rows[indices].min(),
+               cols[indices].max() + 1, rows[indices].max() + 1)
+        windows.append((tuple(int(x) for x in roi), indices))
+    return windows
+
+
+def process_masked_flags(band_no, a1_granule, a2_granule,
+                         band_transfer=None, roi=None, cache=None,
+                         pool=None, dtype=np.float32, uncertainty=True):
+    """Processes a band like `process_masked_kernels`, but rather than a
+    mask and QA array, returns the per-pixel flags packed into a single
+    uint8 array (see `pack_flags`), and (if `uncertainty` is True) the
+    decoded `BRDF_Albedo_Uncertainty` layer. Returns the kernels, the
+    flags and the uncertainty (or None)."""
+    if band_transfer is not None:
+        band_no = band_transfer[band_no]
+    fdata, fqa = band_layers(band_no, a1_granule, a2_granule)
+    raw_kernels = read_layer(*fdata, roi=roi, cache=cache, pool=pool)
+    kernels = process_kernels(raw_kernels, dtype=dtype)
+    snow = read_layer(a2_granule, 'Snow_BRDF_Albedo', roi=roi,
+                      process=process_snow, cache=cache, pool=pool)
+    land = read_layer(a2_granule, 'BRDF_Albedo_LandWaterType', roi=roi,
+                      process=process_land, cache=cache, pool=pool)
+    qa = read_layer(*fqa, roi=roi, cache=cache, pool=pool)
+    flags = pack_flags(snow, land, qa, fill=raw_kernels[0] == KERNEL_FILL)
+    unc = None
+    if uncertainty:
+        unc = read_layer(a2_granule, 'BRDF_Albedo_Uncertainty', roi=roi,
+                         process=process_unc, cache=cache, pool=pool)
+        if cache is not None:
+            unc = unc.copy()
+    return kernels, flags, unc
+
+
+def pack_flags(snow, land, qa, fill=None):
+    """Packs the snow free and land masks, the raw QA values and an
+    optional fill mask into a uint8 array of per-pixel flags. Bit 0
+    (`FLAG_SNOW_FREE`) is set for snow free retrievals, bit 1
+    (`FLAG_LAND`) for land pixels, bit 2 (`FLAG_FILL`) for fill values,
+    and bits 3 to 5 hold the QA class (7 for fill)."""
+    fill = qa == QA_FILL if fill is None else fill | (qa == QA_FILL)
+    flags = np.minimum(qa, 7).astype(np.uint8)
+    flags[fill] = 7
+    flags <<= FLAG_QA_SHIFT
+    flags |= snow.astype(np.uint8)
+    flags |= land.astype(np.uint8) << 1
+    flags |= fill.astype(np.uint8) << 2
+    return flags
+
+
+def flags_snow_free(flags):
+    """True for snow free retrievals."""
+    return (flags & FLAG_SNOW_FREE) != 0
+
+
+def flags_land(flags):
+    """True for land pixels."""
+    return (flags & FLAG_LAND) != 0
+
+
+def flags_fill(flags):
+    """True for fill values."""
+    return (flags & FLAG_FILL) != 0
+
+
+def flags_qa(flags):
+    """The QA class of each pixel (0 best to 4, 7 for fill)."""
+    return (flags & FLAG_QA_BITS) >> FLAG_QA_SHIFT
+
+
+def flags_to_mask(flags, max_qa=1, land_only=False):
+    """Builds a valid pixels mask from the packed flags: snow free,
+    non fill retrievals with a QA class of at most `max_qa` and,
+    optionally, only over land. With the defaults, this is the mask
+    `process_masked_kernels` returns, with fill pixels always excluded."""
+    mask = (flags & (FLAG_SNOW_FREE | FLAG_FILL)) == FLAG_SNOW_FREE
+    mask &= flags_qa(flags) <= max_qa
+    if land_only:
+        mask &= flags_land(flags)
+    return mask
+
+
+def pack_mask(mask):
+    """Packs a boolean mask into a uint8 array along its last axis
+    (eight pixels per byte)."""
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, n_cols):
+    """Unpacks a mask packed with `pack_mask`, given its original
+    number of columns."""
+    return np.unpackbits(packed, axis=-1, count=n_cols).astype(bool)
+
+
+SparseDescriptors = namedtuple("SparseDescriptors",
+                               ["index", "kernels", "qa", "shape"])
+SparseDescriptors.__doc__ = """The valid pixels of a single date: their
+flat `index` into the (y, x) `shape` of the image, and their (n_valid, 3)
+`kernels` and (n_valid,) `qa`."""
+
+SparseTimeSeries = namedtuple("SparseTimeSeries",
+                              ["dates", "offsets", "index", "kernels",
+                               "qa", "shape"])
+SparseTimeSeries.__doc__ = """The valid pixels of several dates, stored
+one date after the other. The pixels of `dates[i]` are the ones between
+`offsets[i]` and `offsets[i + 1]`."""
+
+
+def to_sparse(kernels, mask, qa):
+    """Keeps only the valid (i.e. `mask` is True) pixels of a (3, y, x)
+    kernels array and its QA. Returns a `SparseDescriptors` tuple."""
+    index = np.flatnonzero(mask).astype(np.int32)
+    kernels = kernels.reshape((3, -1))[:, index].T
+    qa = qa.reshape(-1)[index]
+    return SparseDescriptors(index, kernels, qa, mask.shape)
+
+
+def to_dense(sparse):
+    """Scatters a `SparseDescriptors` tuple back into (3, y, x) kernels
+    and (y, x) mask and QA arrays, with NaN for the invalid pixels (or,
+    for integer arrays such as raw kernels, `KERNEL_FILL` and
+    `QA_FILL`)."""
+    n_pixels = int(np.prod(sparse.shape))
+    kernels_fill = KERNEL_FILL \
+        if np.issubdtype(sparse.kernels.dtype, np.integer) else np.nan
+    qa_fill = QA_FILL if np.issubdtype(sparse.qa.dtype, np.integer) \
+        else np.nan
+    kernels = np.full((3, n_pixels), kernels_fill,
+                      dtype=sparse.kernels.dtype)
+    mask = np.zeros(n_pixels, dtype=bool)
+    qa = np.full(n_pixels, qa_fill, dtype=sparse.qa.dtype)
+    kernels[:, sparse.index] = sparse.kernels.T
+    mask[sparse.index] = True
+    qa[sparse.index] = sparse.qa
+    return (kernels.reshape((3,) + tuple(sparse.shape)),
+            mask.reshape(sparse.shape), qa.reshape(sparse.shape))
+
+
+def stack_sparse(dates, sparse_list):
+    """Concatenates the `SparseDescriptors` of several dates into a
+    `SparseTimeSeries`."""
+    if len(sparse_list) == 0:
+        raise ValueError("No dates to stack!")
+    counts = [len(sparse.index) for sparse in sparse_list]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return SparseTimeSeries(
+        list(dates), offsets,
+        np.concatenate([sparse.index for sparse in sparse_list]),
+        np.concatenate([sparse.kernels for sparse in sparse_list]),
+        np.concatenate([sparse.qa for sparse in sparse_list]),
+        sparse_list[0].shape)
+
+
+def sparse_date(series, i):
+    """Returns the `SparseDescriptors` of the i-th date of a
+    `SparseTimeSeries`, as views into it."""
+    pixels = slice(series.offsets[i], series.offsets[i + 1])
+    return SparseDescriptors(series.index[pixels], series.kernels[pixels],
+                             series.qa[pixels], series.shape)
+
+
+def process_unc(unc, dtype=np.float32):
+    """Decodes the `BRDF_Albedo_Uncertainty` layer: values are scaled by
+    `KERNEL_SCALE` into a `dtype` array, with NaN where they are
+    `KERNEL_FILL`."""
+    return process_kernels(unc, dtype=dtype)
+
+
+def process_land(land):
+    """Returns True for land pixels"""
+    t0 = time.perf_counter() if PROBES else None
+    land = np.isin(land, LAND_TYPES)
+    if t0 is not None:
+        record("decode", t0, nbytes=land.nbytes, n_arrays=1)
+    return land
 
 
 def process_snow(snow):
     """Returns True if snow free albedo retrieval"""
-    return np.where(snow == 0, True, False)
+    t0 = time.perf_counter() if PROBES else None
+    snow = snow == 0
+    if t0 is not None:
+        record("decode", t0, nbytes=snow.nbytes, n_arrays=1)
+    return snow
 
 
-def process_kernels(kernels):
-    """Scales the kernels, maybe does other things"""
-    kernels = np.where(kernels == 32767, np.nan, kernels/1000.)
-    return kernels
+def process_kernels(kernels, out=None, dtype=np.float32):
+    """Scales the kernels, maybe does other things. The scaled kernels
+    are written into `out` if given, otherwise into a new `dtype` array.
+    The scaling is done one kernel at a time, so that the only temporary
+    is a boolean fill mask of a single kernel."""
+    t0 = time.perf_counter() if PROBES else None
+    n_arrays = 0
+    if out is None:
+        out = np.empty(kernels.shape, dtype=dtype)
+        n_arrays = 1
+    planes = zip(kernels, out) if kernels.ndim == 3 else [(kernels, out)]
+    for plane, plane_out in planes:
+        np.multiply(plane, KERNEL_SCALE, out=plane_out)
+        np.copyto(plane_out, np.nan, where=plane == KERNEL_FILL)
+    if t0 is not None:
+        record("decode", t0, nbytes=out.nbytes, n_arrays=n_arrays)
+    return out
 
 
 class RetrieveBRDFDescriptors(object):
     """Retrieving BRDF descriptors."""
 
     def __init__(self, tile, mcd43a1_dir, start_time, end_time=None,
-                 mcd43a2_dir=None, roi=None):
+                 mcd43a2_dir=None, roi=None, cache=None, pool=None,
+                 store_dir=None, dtype=np.float32, index_file=None):
         """The class needs to locate the data granules. We assume that
         these are available somewhere in the filesystem and that we can
         index them by location (MODIS tile name e.g. "h19v10") and
@@ -194,7 +932,14 @@ class RetrieveBRDFDescriptors(object):
         in the same folder. We also need a starting date (either a
         datetime object, or a string in "%Y-%m-%d" or "%Y%j" format. If
         the end time is not specified, it will be set to the date of the
-        latest granule found."""
+        latest granule found. An optional `LayerCache` can be given to
+        keep recently read layers in memory, and an optional
+        `DatasetPool` to keep recently opened datasets open. If
+        `store_dir` holds a store for the tile written by
+        `store.convert_to_store`, the bands and dates it contains are
+        read from it rather than from the HDF granules. Kernels and QA
+        are returned as `dtype` arrays. Granules are looked up in the
+        granule index `index_file` if given (see `find_granules`)."""
 
         self.tile = tile
         self.start_time = process_time_input(start_time)
@@ -207,7 +952,8 @@ class RetrieveBRDFDescriptors(object):
         else:
             raise IOError("mcd43a1_dir does not exist!")
         self.a1_granules = find_granules(self.mcd43a1_dir, tile, "A1",
-                                         self.start_time, self.end_time)
+                                         self.start_time, self.end_time,
+                                         index_file=index_file)
         if mcd43a2_dir is None:
             self.mcd43a2_dir = mcd43a1_dir
         else:
@@ -216,13 +962,23 @@ class RetrieveBRDFDescriptors(object):
             else:
                 raise IOError("mcd43a2_dir does not exist!")
         self.a2_granules = find_granules(self.mcd43a2_dir, tile, "A2",
-                                         self.start_time, self.end_time)
+                                         self.start_time, self.end_time,
+                                         index_file=index_file)
         a1_dates = set(self.a1_granules.keys())
         a2_dates = set(self.a2_granules.keys())
         if a1_dates != a2_dates:
             raise ValueError("A1 and A2 product files do not overlap!")
 
         self.band_transfer = None
+        self.dtype = dtype
+        self.cache = cache
+        self.pool = pool
+        self.store = None
+        self._tile_shape = None
+        if store_dir is not None:
+            from .store import MCD43Store
+            if MCD43Store.exists(store_dir, tile):
+                self.store = MCD43Store(store_dir, tile)
 
         if roi is not None:
             assert len(roi) == 4,\
@@ -233,34 +989,339 @@ class RetrieveBRDFDescriptors(object):
             self.roi = roi
         else:
             self.roi = None
-    def get_brdf_descriptors(self, band_no, date):
+    def get_brdf_descriptors(self, band_no, date, raw=False, sparse=False,
+                             shared=None):
+        """Retrieves the kernels, mask and QA for a band on a given date,
+        or None if there is no data for that date. If `raw` is True, the
+        kernels are returned as the int16 values stored in the granules,
+        and the scale factor to apply to them is returned as a fourth
+        element. If `sparse` is True, only the valid pixels are returned,
+        as a `SparseDescriptors` tuple (see `to_sparse` and `to_dense`)
+        instead of the kernels, mask and QA. If `shared` is a
+        `shared.SharedArrays` object, the kernels, mask and QA are
+        decoded straight into shared memory blocks owned by it, and
+        their `SharedArray` descriptors are returned instead of the
+        arrays, for worker processes to use with `attach_shared`."""
         #        if not (1 <= band_no <= 7) :
         #            raise ValueError ("Bands can only go from 1 to 7!")
 
+        granules = self._granules(date)
+        if granules is None:
+            return None
+        the_date, a1_granule, a2_granule = granules
+        if sparse and shared is not None:
+            raise ValueError("Sparse outputs can't be shared!")
+        out = None
+        if shared is not None:
+            ny, nx = self._output_shape(band_no, the_date)
+            out, descriptors = zip(*[
+                shared.empty((3, ny, nx), np.int16 if raw else self.dtype),
+                shared.empty((ny, nx), bool),
+                shared.empty((ny, nx), self.dtype)])
+        if not raw and self._in_store(band_no, [the_date]):
+            kernels, mask, qa = self.store.get_brdf_descriptors(
+                self._store_band(band_no), the_date, roi=self.roi,
+                dtype=self.dtype)
+            if out is not None:
+                for array, output in zip((kernels, mask, qa), out):
+                    np.copyto(output, array)
+        else:
+            kernels, mask, qa = process_masked_kernels(band_no, a1_granule,
+                                                       a2_granule,
+                                                       band_transfer=self.band_transfer,
+                                                       roi=self.roi,
+                                                       out=out,
+                                                       cache=self.cache,
+                                                       pool=self.pool,
+                                                       dtype=self.dtype,
+                                                       raw=raw)
+        if sparse:
+            retval = (to_sparse(kernels, mask, qa),)
+        elif shared is not None:
+            retval = descriptors
+        else:
+            retval = (kernels, mask, qa)
+        if raw:
+            retval = retval + (KERNEL_SCALE,)
+        return retval[0] if len(retval) == 1 else retval
+
+    def get_sparse_time_series(self, band_no, start_time=None,
+                               end_time=None, n_threads=4):
+        """Retrieves the valid pixels of a band for all the available
+        dates between `start_time` and `end_time` (both inclusive), read
+        by a pool of `n_threads` threads. Only one dense date per thread
+        is held in memory at any time. Returns a `SparseTimeSeries`."""
+        dates = self._dates_between(start_time, end_time)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            sparse_list = list(executor.map(
+                lambda date: self.get_brdf_descriptors(band_no, date,
+                                                       sparse=True),
+                dates))
+        return stack_sparse(dates, sparse_list)
+
+    def _granules(self, date):
+        """Returns the date (as a datetime) and the A1 and A2 granules
+        for a date, or None if there are no granules for it."""
         the_date = process_time_input(date)
         try:
-            a1_granule = self.a1_granules[the_date]
+            return the_date, self.a1_granules[the_date], \
+                self.a2_granules[the_date]
         except KeyError:
             return None
-        a2_granule = self.a2_granules[the_date]
-        kernels, mask, qa = process_masked_kernels(band_no, a1_granule,
-                                                   a2_granule,
-                                                   band_transfer=self.band_transfer,
-                                                   roi=self.roi)
-        return kernels, mask, qa
-
-
-if __name__ == "__main__":
-    mcd43a1_dir = "/group_workspaces/cems2/qa4ecv/vol2/modis.c6.brdf/ladsweb.nascom.nasa.gov/allData/6/MCD43A1/2015/"
-    mcd43a2_dir = "/group_workspaces/cems2/qa4ecv/vol2/modis.c6.brdf/ladsweb.nascom.nasa.gov/allData/6/MCD43A2/2015/"
-    rr = RetrieveBRDFDescriptors("h17v05",
-                                 mcd43a1_dir, 
-                                 "2015-01-01", mcd43a2_dir=mcd43a2_dir,
-                                 end_time="2015-12-31")
-    roi=[1100, 640, 1400,740]
-    rr_chunk = RetrieveBRDFDescriptors("h17v05",
-                                 mcd43a1_dir,
-                                 "2015-01-01", 
-                                 mcd43a2_dir=mcd43a2_dir,
-                                 end_time="2015-12-31",
-                                    roi=roi)
+
+    def _dates_between(self, start_time=None, end_time=None):
+        """Returns the sorted dates with granules between `start_time`
+        (defaulting to the start time of the retriever) and `end_time`
+        (both inclusive), or raises ValueError if there are none."""
+        start_time = self.start_time if start_time is None \
+            else process_time_input(start_time)
+        end_time = None if end_time is None \
+            else process_time_input(end_time)
+        dates = sorted(date for date in self.a1_granules
+                       if date >= start_time and
+                       (end_time is None or date <= end_time))
+        if len(dates) == 0:
+            raise ValueError("No granules between %s and %s" %
+                             (start_time, end_time))
+        return dates
+
+    def _store_band(self, band_no):
+        if self.band_transfer is not None:
+            band_no = self.band_transfer[band_no]
+        return band_no
+
+    def _in_store(self, band_no, dates, check_roi=True):
+        """Checks whether a band and a set of dates can be read from
+        the store, and (if `check_roi` is True) whether the store covers
+        the ROI (or the whole tile if there's no ROI)."""
+        if self.store is None or \
+                not self.store.has_band(self._store_band(band_no)):
+            return False
+        if not all(date in self.store._date_index for date in dates):
+            return False
+        if not check_roi:
+            return True
+        ulx0, uly0, lrx0, lry0 = self.store.roi
+        if self.roi is not None:
+            ulx, uly, lrx, lry = self.roi
+        else:
+            ulx, uly = 0, 0
+            lry, lrx = self._tile_size(band_no, dates[0])
+        return ulx >= ulx0 and uly >= uly0 and lrx <= lrx0 and lry <= lry0
+
+    def _output_shape(self, band_no, date):
+        """Returns the (y, x) shape of the outputs for a band, either
+        from the ROI or from the size of the granule of a date."""
+        if self.roi is not None:
+            ulx, uly, lrx, lry = self.roi
+            return lry - uly, lrx - ulx
+        return self._tile_size(band_no, date)
+
+    def _tile_size(self, band_no, date):
+        """Returns the (y, x) shape of the granules, read from the layer
+        of a band on a date the first time."""
+        if self._tile_shape is not None:
+            return self._tile_shape
+        band = band_no if self.band_transfer is None \
+            else self.band_transfer[band_no]
+        fdata, _ = band_layers(band, self.a1_granules[date],
+                               self.a2_granules[date])
+        fname = granule_layer(*fdata)
+        g = gdal.Open(fname) if self.pool is None \
+            else self.pool.open(fname)
+        if g is None:
+            raise IOError("Can't open %s" % fname)
+        self._tile_shape = g.RasterYSize, g.RasterXSize
+        return self._tile_shape
+
+    def get_time_series(self, band_no, start_time=None, end_time=None,
+                        n_threads=4):
+        """Retrieves the kernels, mask and QA for a band for all the
+        available dates between `start_time` and `end_time` (both
+        inclusive, defaulting to the whole period). The outputs are
+        preallocated as (time, 3, y, x) kernels and (time, y, x) mask
+        and QA arrays, and filled by a pool of `n_threads` threads.
+        Returns a list of dates, and the kernels, mask and QA arrays."""
+        dates = self._dates_between(start_time, end_time)
+        if self._in_store(band_no, dates):
+            return self.store.get_time_series(self._store_band(band_no),
+                                              dates[0], dates[-1],
+                                              roi=self.roi,
+                                              dtype=self.dtype)
+        ny, nx = self._output_shape(band_no, dates[0])
+        kernels = np.empty((len(dates), 3, ny, nx), dtype=self.dtype)
+        mask = np.empty((len(dates), ny, nx), dtype=bool)
+        qa = np.empty((len(dates), ny, nx), dtype=self.dtype)
+
+        def read_date(i):
+            process_masked_kernels(band_no, self.a1_granules[dates[i]],
+                                   self.a2_granules[dates[i]],
+                                   band_transfer=self.band_transfer,
+                                   roi=self.roi, cache=self.cache,
+                                   pool=self.pool, dtype=self.dtype,
+                                   out=(kernels[i], mask[i], qa[i]))
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # Consume the results, so that exceptions are raised here
+            list(executor.map(read_date, range(len(dates))))
+        return dates, kernels, mask, qa
+
+    def iter_descriptors(self, band_no, dates=None, prefetch=2):
+        """Iterates over `dates` (defaulting to all the available dates)
+        in order, yielding `(date, kernels, mask, qa)` tuples. A
+        background thread reads up to `prefetch` dates ahead of the
+        consumer, so reading the next granule overlaps with whatever the
+        consumer does with the current one. At most `prefetch` + 1 dates
+        are held in memory by the iterator. Dates with no data are
+        skipped."""
+        if dates is None:
+            dates = sorted(self.a1_granules.keys())
+        else:
+            dates = [process_time_input(date) for date in dates]
+        if prefetch < 1:
+            raise ValueError("prefetch must be at least 1")
+        results = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for date in dates:
+                    retval = self.get_brdf_descriptors(band_no, date)
+                    if retval is not None and \
+                            not put((date,) + tuple(retval)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(done)
+
+        reader = threading.Thread(target=worker, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+
+    def get_brdf_descriptors_tiled(self, band_no, date, block_size=512,
+                                   n_workers=None):
+        """Retrieves the kernels, mask and QA for a band on a given date,
+        processing the tile (or ROI) in blocks across a pool of
+        `n_workers` processes (see `process_masked_kernels_tiled`).
+        Returns None if there is no data for that date."""
+        granules = self._granules(date)
+        if granules is None:
+            return None
+        _, a1_granule, a2_granule = granules
+        return process_masked_kernels_tiled(
+            band_no, a1_granule, a2_granule,
+            band_transfer=self.band_transfer, roi=self.roi,
+            block_size=block_size, n_workers=n_workers, dtype=self.dtype)
+
+    def get_pixel_time_series(self, band_no, rows, cols, start_time=None,
+                              end_time=None, latlon=False, window_size=64,
+                              n_threads=4):
+        """Extracts the kernels time series for a set of scattered pixels,
+        given by their `rows` and `cols` in the tile (or, if `latlon` is
+        True, by their latitudes and longitudes). Nearby pixels are
+        grouped into small windows (see `group_pixels`), and each layer
+        of each granule is only opened once. Dates are read in parallel
+        by `n_threads` threads. Returns the dates, (n_points, time, 3)
+        kernels, and (n_points, time) mask and QA arrays. Raises
+        ValueError if any of the pixels is outside the tile."""
+        points = rows, cols
+        if latlon:
+            from .sinusoidal import latlon_to_tile_pixel
+            rows, cols = latlon_to_tile_pixel(rows, cols, tile=self.tile)
+        rows = np.atleast_1d(rows).astype(int)
+        cols = np.atleast_1d(cols).astype(int)
+        dates = self._dates_between(start_time, end_time)
+        ny, nx = self._tile_size(band_no, dates[0])
+        outside = np.flatnonzero((rows < 0) | (rows >= ny) |
+                                 (cols < 0) | (cols >= nx))
+        if len(outside) > 0:
+            outside_points = list(zip(
+                np.atleast_1d(points[0])[outside].tolist(),
+                np.atleast_1d(points[1])[outside].tolist()))
+            raise ValueError("Points %s are outside tile %s" %
+                             (outside_points, self.tile))
+        if self._in_store(band_no, dates, check_roi=False) and \
+                self.store.contains(rows, cols):
+            _, kernels, mask, qa = self.store.get_points_time_series(
+                self._store_band(band_no), rows, cols, dates[0], dates[-1],
+                dtype=self.dtype)
+            return dates, kernels, mask, qa
+        band = band_no if self.band_transfer is None \
+            else self.band_transfer[band_no]
+        windows = group_pixels(rows, cols, window_size=window_size)
+        pool = self.pool if self.pool is not None \
+            else DatasetPool(max_open=8)
+        kernels = np.empty((len(rows), len(dates), 3), dtype=self.dtype)
+        mask = np.empty((len(rows), len(dates)), dtype=bool)
+        qa = np.empty((len(rows), len(dates)), dtype=self.dtype)
+
+        def read_date(i):
+            a1_granule = self.a1_granules[dates[i]]
+            a2_granule = self.a2_granules[dates[i]]
+            for roi, indices in windows:
+                snow = read_layer(a2_granule, 'Snow_BRDF_Albedo', roi=roi,
+                                  process=process_snow, pool=pool)
+                window_kernels, window_mask, window_qa = process_band(
+                    band, a1_granule, a2_granule, snow, roi=roi, pool=pool,
+                    dtype=self.dtype)
+                row = rows[indices] - roi[1]
+                col = cols[indices] - roi[0]
+                kernels[indices, i] = window_kernels[:, row, col].T
+                mask[indices, i] = window_mask[row, col]
+                qa[indices, i] = window_qa[row, col]
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(read_date, range(len(dates))))
+        return dates, kernels, mask, qa
+
+    def get_brdf_flags(self, band_no, date, uncertainty=True):
+        """Retrieves the kernels for a band on a given date, together with
+        the per-pixel flags packed into a uint8 array (see `pack_flags`
+        and the `flags_*` accessors) and the decoded uncertainty layer.
+        Returns None if there is no data for that date."""
+        granules = self._granules(date)
+        if granules is None:
+            return None
+        _, a1_granule, a2_granule = granules
+        return process_masked_flags(band_no, a1_granule, a2_granule,
+                                    band_transfer=self.band_transfer,
+                                    roi=self.roi, cache=self.cache,
+                                    pool=self.pool, dtype=self.dtype,
+                                    uncertainty=uncertainty)
+
+    def get_brdf_descriptors_multiband(self, bands, date):
+        """Retrieves the kernels, mask and QA for several bands on a
+        given date in one go, reading the layers shared by all the bands
+        only once. Returns a (band, 3, y, x) kernels array, and
+        (band, y, x) mask and QA arrays, or None if there is no data for
+        that date."""
+        granules = self._granules(date)
+        if granules is None:
+            return None
+        _, a1_granule, a2_granule = granules
+        return process_masked_kernels_multiband(
+            bands, a1_granule, a2_granule,
+            band_transfer=self.band_transfer, roi=self.roi,
+            cache=self.cache, pool=self.pool, dtype=self.dtype)
+
@@ -8,4 +8,30 @@ __email__ = "j.gomez-dans@ucl.ac.uk"
 
 from .BRDF_descriptors import process_time_input
 from .BRDF_descriptors import find_granules
+from .BRDF_descriptors import GranuleIndex
+from .BRDF_descriptors import build_granule_index
+from .BRDF_descriptors import LayerCache
+from .BRDF_descriptors import DatasetPool
 from .BRDF_descriptors import RetrieveBRDFDescriptors
+from .store import MCD43Store
+from .store import convert_to_store
+from .kernels import kernel_values
+from .kernels import predict_reflectance
+from .albedo import black_sky_albedo
+from .albedo import white_sky_albedo
+from .albedo import broadband_albedo
+from .BRDF_descriptors import pack_flags
+from .BRDF_descriptors import flags_to_mask
+from .BRDF_descriptors import pack_mask
+from .BRDF_descriptors import unpack_mask
+from .BRDF_descriptors import to_sparse
+from .BRDF_descriptors import to_dense
+from .BRDF_descriptors import stack_sparse
+from .mosaic import MosaicBRDFDescriptors
+from .instrument import instrument
+from .instrument import add_probe
+from .instrument import remove_probe
+from .shared import SharedArrays
+from .shared import attach_shared
+from .aio import AsyncBRDFService
+from .export import export_tile
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""An asyncio front end to `RetrieveBRDFDescriptors`, for services that
+answer kernel queries from many concurrent callers.
+
+Reads are blocking GDAL calls, so they run in an executor, while at most
+`max_concurrency` of them are in progress at any time (further requests
+wait for a slot). Identical requests (same band, date and options) made
+while a read is in progress are coalesced: they all wait for that read,
+and get the same (read-only) arrays back. Giving the retriever a
+`LayerCache` also shares the layers common to different requests, such
+as the snow mask: each (granule, layer, ROI) is read once, even by
+requests running at the same time, e.g.
+
+    retriever = RetrieveBRDFDescriptors(tile, a1_dir, start,
+                                        cache=LayerCache())
+    async with AsyncBRDFService(retriever, max_concurrency=4) as service:
+        kernels, mask, qa = await service.get_brdf_descriptors(1, date)
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .BRDF_descriptors import process_time_input
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+def _freeze(result):
+    """Makes the arrays in a result read-only, as they are shared by all
+    the callers of a coalesced request."""
+    if isinstance(result, np.ndarray):
+        result.setflags(write=False)
+    elif isinstance(result, tuple):
+        for item in result:
+            _freeze(item)
+    return result
+
+
+class AsyncBRDFService(object):
+    """Asynchronous, coalescing access to a `RetrieveBRDFDescriptors`
+    object. At most `max_concurrency` reads run at once, in `executor`
+    (by default a thread pool of that size, shut down by `close`)."""
+
+    def __init__(self, retriever, max_concurrency=4, executor=None):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency needs to be positive!")
+        self.retriever = retriever
+        self.max_concurrency = max_concurrency
+        self._own_executor = executor is None
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency) \
+            if executor is None else executor
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = {}
+        self.reads = 0
+        self.coalesced = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """Like `close`, but waits for the reads in progress without
+        blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """Shuts down the executor, if it was created by the service,
+        waiting for the reads in progress."""
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """Returns a dictionary with the number of reads done, requests
+        coalesced into them, and requests currently in flight."""
+        return {"reads": self.reads, "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight),
+                "max_concurrency": self.max_concurrency}
+
+    async def _read(self, func, args, kwargs):
+        async with self._semaphore:
+            self.reads += 1
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+        return _freeze(result)
+
+    async def _request(self, key, func, *args, **kwargs):
+        """Runs `func` in the executor, unless a request with the same
+        `key` is already in flight, in which case its result is
+        awaited instead."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._read(func, args, kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(
+                lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A caller being cancelled mustn't cancel the read for the rest
+        return await asyncio.shield(task)
+
+    async def get_brdf_descriptors(self, band_no, date, raw=False):
+        """Like `RetrieveBRDFDescriptors.get_brdf_descriptors`."""
+        date = process_time_input(date)
+        return await self._request(("descriptors", band_no, date, raw),
+                                   self.retriever.get_brdf_descriptors,
+                                   band_no, date, raw=raw)
+
+    async def get_brdf_descriptors_multiband(self, bands, date):
+        """Like
+        `RetrieveBRDFDescriptors.get_brdf_descriptors_multiband`."""
+        date = process_time_input(date)
+        return await self._request(
+            ("multiband", tuple(bands), date),
+            self.retriever.get_brdf_descriptors_multiband, list(bands),
+            date)
+
+    async def get_brdf_flags(self, band_no, date, uncertainty=True):
+        """Like `RetrieveBRDFDescriptors.get_brdf_flags`."""
+        date = process_time_input(date)
+        return await self._request(("flags", band_no, date, uncertainty),
+                                   self.retriever.get_brdf_flags, band_no,
+                                   date, uncertainty=uncertainty)
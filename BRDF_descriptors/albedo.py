@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Vectorised white-sky (WSA) and black-sky (BSA) albedo from the MODIS
+kernel weights, using the polynomial approximations to the kernel
+integrals of the MODIS BRDF/Albedo ATBD (Lucht et al., 2000). Narrowband
+albedos can be converted to visible, NIR and shortwave broadband
+albedo with the Liang (2001) coefficients.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+# BSA polynomial coefficients (g0, g1, g2) for the iso, vol & geo kernels
+BSA_COEFFS = np.array([[1., 0., 0.],
+                       [-0.007574, -0.070987, 0.307588],
+                       [-1.284909, -0.166314, 0.041840]])
+# WSA kernel integrals for the iso, vol & geo kernels
+WSA_COEFFS = np.array([1., 0.189184, -1.377622])
+
+# Narrow to broadband conversion for MODIS bands 1 to 7 (Liang, 2001),
+# as (band coefficients, intercept)
+BROADBAND_COEFFS = {
+    "vis": (np.array([0.331, 0., 0.424, 0.246, 0., 0., 0.]), 0.),
+    "nir": (np.array([0.039, 0.504, -0.071, 0.105, 0.252, 0.069, 0.101]),
+            0.),
+    "shortwave": (np.array([0.160, 0.291, 0.243, 0.116, 0.112, 0., 0.081]),
+                  -0.0015)}
+
+
+def _chunks(n_rows, chunk_rows):
+    if chunk_rows is None:
+        chunk_rows = n_rows
+    for start in range(0, n_rows, chunk_rows):
+        yield slice(start, min(start + chunk_rows, n_rows))
+
+
+def _albedo(kernels, weights, mask, out, chunk_rows):
+    """Computes sum_k weights_k * kernels_k over the kernel axis of a
+    (..., 3, y, x) array, in chunks of `chunk_rows` rows."""
+    kernels = np.asarray(kernels)
+    if kernels.ndim < 3 or kernels.shape[-3] != 3:
+        raise ValueError("Kernels need to be a (..., 3, y, x) array!")
+    shape = kernels.shape[:-3] + kernels.shape[-2:]
+    weights = [np.broadcast_to(w, shape) for w in weights]
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(kernels.dtype,
+                                                    np.float32))
+    for rows in _chunks(shape[-2], chunk_rows):
+        window = (Ellipsis, rows, slice(None))
+        chunk = out[window]
+        np.multiply(kernels[..., 0, rows, :], weights[0][window], out=chunk)
+        chunk += kernels[..., 1, rows, :] * weights[1][window]
+        chunk += kernels[..., 2, rows, :] * weights[2][window]
+        if mask is not None:
+            chunk[~np.broadcast_to(mask, shape)[window]] = np.nan
+    return out
+
+
+def black_sky_albedo(kernels, sza, mask=None, out=None, chunk_rows=None):
+    """Black-sky (directional hemispherical) albedo for a (..., 3, y, x)
+    array of kernel weights, and a solar zenith angle (in degrees) that
+    broadcasts against (..., y, x). Pixels where `mask` is False are
+    set to NaN. The result can be written into `out`, and is computed in
+    blocks of `chunk_rows` rows to limit the size of the temporaries."""
+    sza = np.radians(sza)
+    sza2 = sza * sza
+    sza3 = sza2 * sza
+    weights = [g0 + g1 * sza2 + g2 * sza3 for g0, g1, g2 in BSA_COEFFS]
+    return _albedo(kernels, weights, mask, out, chunk_rows)
+
+
+def white_sky_albedo(kernels, mask=None, out=None, chunk_rows=None):
+    """White-sky (bihemispherical) albedo for a (..., 3, y, x) array of
+    kernel weights. See `black_sky_albedo` for the other options."""
+    return _albedo(kernels, WSA_COEFFS, mask, out, chunk_rows)
+
+
+def broadband_albedo(kernels, sza=None, mask=None, chunk_rows=None):
+    """Visible, NIR and shortwave broadband albedo from a multiband
+    (7, ..., 3, y, x) stack of kernel weights for MODIS bands 1 to 7,
+    such as the one returned by
+    `RetrieveBRDFDescriptors.get_brdf_descriptors_multiband`. If `sza`
+    is given, black-sky albedo is used, otherwise white-sky albedo.
+    `mask` can either be shared by all bands, or be a per band
+    (7, ..., y, x) array. Returns a dictionary with the "vis", "nir" and
+    "shortwave" albedos. Only one narrowband albedo is held in memory
+    at a time."""
+    if len(kernels) != 7:
+        raise ValueError("Broadband albedo needs MODIS bands 1 to 7!")
+    per_band_mask = mask is not None and \
+        np.ndim(mask) == np.ndim(kernels) - 1
+    broadband = {}
+    narrowband = None
+    for band in range(7):
+        band_mask = mask[band] if per_band_mask else mask
+        if sza is None:
+            narrowband = white_sky_albedo(kernels[band], mask=band_mask,
+                                          out=narrowband,
+                                          chunk_rows=chunk_rows)
+        else:
+            narrowband = black_sky_albedo(kernels[band], sza,
+                                          mask=band_mask, out=narrowband,
+                                          chunk_rows=chunk_rows)
+        for name, (coeffs, intercept) in BROADBAND_COEFFS.items():
+            if name not in broadband:
+                broadband[name] = np.full(narrowband.shape, intercept,
+                                          dtype=narrowband.dtype)
+            if coeffs[band] != 0.:
+                broadband[name] += coeffs[band] * narrowband
+    return broadband
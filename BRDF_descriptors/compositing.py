@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""Incremental QA-weighted temporal compositing of MCD43 kernels.
+
+Rather than building a full (time, 3, y, x) stack, the compositor keeps
+running weighted means and variances (West, 1979) for the windows that
+are currently open, and updates them as each date is read. Windows of
+`window` days start every `stride` days, so only about
+`window / stride` sets of statistics are held in memory at any time.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from collections import namedtuple
+
+import numpy as np
+
+from .BRDF_descriptors import process_time_input
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+Composite = namedtuple("Composite", ["start", "end", "mean", "variance",
+                                     "weight", "n_obs", "filled"])
+Composite.__doc__ = """A composite over the dates in [`start`, `end`):
+the (3, y, x) weighted `mean` and `variance` of the kernels, the (y, x)
+sum of the weights and number of observations, and a (y, x) mask of the
+pixels that were gap filled (or None)."""
+
+
+def qa_weights(qa):
+    """Default weights for the QA values returned by
+    `RetrieveBRDFDescriptors`: 1 / (1 + QA), so that best quality
+    retrievals weigh twice as much as good ones. Masked (NaN) pixels get
+    a weight of 0."""
+    weights = 1. / (1. + qa)
+    weights[np.isnan(weights)] = 0.
+    return weights
+
+
+class RunningStats(object):
+    """Weighted running mean and variance of (3, y, x) kernels."""
+
+    def __init__(self, shape, dtype=np.float64):
+        self.weight = np.zeros(shape[-2:], dtype=dtype)
+        self.n_obs = np.zeros(shape[-2:], dtype=np.int32)
+        self.mean = np.zeros(shape, dtype=dtype)
+        self.m2 = np.zeros(shape, dtype=dtype)
+
+    def update(self, kernels, weights):
+        """Adds a date's kernels, with a (y, x) array of weights (0 for
+        invalid pixels, which can have NaN kernels)."""
+        valid = weights > 0
+        self.weight += weights
+        self.n_obs += valid
+        ratio = np.zeros(self.weight.shape, dtype=self.mean.dtype)
+        np.divide(weights, self.weight, out=ratio, where=valid)
+        delta = np.where(valid, kernels - self.mean, 0.)
+        self.mean += delta * ratio
+        delta *= np.where(valid, kernels - self.mean, 0.)
+        delta *= weights
+        self.m2 += delta
+
+    def result(self):
+        """Returns the weighted mean and variance, NaN for pixels with
+        no observations."""
+        empty = self.weight == 0
+        mean = self.mean.copy()
+        mean[:, empty] = np.nan
+        variance = np.divide(self.m2, self.weight,
+                             out=np.full_like(self.m2, np.nan),
+                             where=~empty)
+        return mean, variance
+
+
+class TemporalCompositor(object):
+    """Builds composites over windows of `window` days, starting every
+    `stride` days from `origin` (by default the first date added).
+    Dates have to be added in order with `add`, which returns the
+    composites of the windows that have been completed. `flush` returns
+    the ones still open. If `gap_fill` is True, pixels without
+    observations in a window are filled from the last composite where
+    they had some."""
+
+    def __init__(self, window=16, stride=8, origin=None,
+                 weight_function=qa_weights, gap_fill=False):
+        if window < 1 or stride < 1:
+            raise ValueError("window and stride need to be positive!")
+        self.window = datetime.timedelta(days=window)
+        self.stride = datetime.timedelta(days=stride)
+        self.next_start = None if origin is None \
+            else process_time_input(origin)
+        self.weight_function = weight_function
+        self.gap_fill = gap_fill
+        self.last_date = None
+        self.shape = None
+        self._open = []
+        self._filled_mean = None
+        self._filled_variance = None
+
+    def _emit(self, start, stats):
+        mean, variance = stats.result()
+        filled = None
+        if self.gap_fill:
+            if self._filled_mean is None:
+                self._filled_mean = np.full_like(mean, np.nan)
+                self._filled_variance = np.full_like(variance, np.nan)
+            empty = stats.weight == 0
+            filled = empty & ~np.isnan(self._filled_mean[0])
+            mean[:, empty] = self._filled_mean[:, empty]
+            variance[:, empty] = self._filled_variance[:, empty]
+            self._filled_mean = mean
+            self._filled_variance = variance
+        return Composite(start, start + self.window, mean, variance,
+                         stats.weight, stats.n_obs, filled)
+
+    def add(self, date, kernels, mask, qa):
+        """Adds a date. Returns a (possibly empty) list of completed
+        composites."""
+        date = process_time_input(date)
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError("Dates need to be added in order!")
+        self.last_date = date
+        if self.shape is None:
+            self.shape = kernels.shape
+        if self.next_start is None:
+            self.next_start = date
+        completed = []
+        while self._open and self._open[0][0] + self.window <= date:
+            completed.append(self._emit(*self._open.pop(0)))
+        while self.next_start <= date:
+            if self.next_start + self.window > date:
+                self._open.append((self.next_start,
+                                   RunningStats(self.shape)))
+            else:
+                # A window with no dates at all
+                completed.append(self._emit(self.next_start,
+                                            RunningStats(self.shape)))
+            self.next_start += self.stride
+        weights = self.weight_function(qa)
+        weights[~mask] = 0.
+        for start, stats in self._open:
+            stats.update(kernels, weights)
+        return completed
+
+    def flush(self):
+        """Returns the composites of all the windows still open."""
+        completed = [self._emit(*window) for window in self._open]
+        self._open = []
+        return completed
+
+
+def fill_gaps(kernels, mask, composite):
+    """Fills the masked pixels of a date's (3, y, x) kernels with the
+    mean of a composite. Returns the filled kernels and a mask of the
+    pixels that were filled."""
+    filled = ~mask & ~np.isnan(composite.mean[0])
+    kernels = kernels.copy()
+    kernels[:, filled] = composite.mean[:, filled]
+    return kernels, filled
+
+
+def composite(retriever, band_no, start_time=None, end_time=None,
+              window=16, stride=8, weight_function=qa_weights,
+              gap_fill=False, prefetch=2):
+    """Yields the composites of a band from a `RetrieveBRDFDescriptors`
+    object, reading the dates between `start_time` and `end_time` in
+    order (with a background prefetch, see
+    `RetrieveBRDFDescriptors.iter_descriptors`)."""
+    dates = retriever._dates_between(start_time, end_time)
+    compositor = TemporalCompositor(window=window, stride=stride,
+                                    origin=retriever.start_time
+                                    if start_time is None else start_time,
+                                    weight_function=weight_function,
+                                    gap_fill=gap_fill)
+    for date, kernels, mask, qa in retriever.iter_descriptors(
+            band_no, dates, prefetch=prefetch):
+        for result in compositor.add(date, kernels, mask, qa):
+            yield result
+    for result in compositor.flush():
+        yield result
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""Batch export of MCD43 tile time series to compressed, chunked NetCDF4
+or Zarr stores, for analysis ready copies of an archive.
+
+For each tile, a single store is written, with these variables per band:
+
+* `kernels_<band>`: (time, kernel, y, x) int16 kernels as stored in the
+  granules (`scale_factor` 0.001, `_FillValue` 32767).
+* `mask_<band>`: (time, y, x_packed) uint8 masks, packed along x with
+  `pack_mask` (eight pixels per byte).
+* `qa_<band>`: (time, y, x) uint8 QA values (255 for masked pixels).
+
+Chunks are long in time and small in space, so that pixel time series
+can be read without touching the whole archive. Dates are read in
+parallel by a pool of processes, and appended to the store a time chunk
+at a time. Exports are resumable: dates already in the store are
+skipped. From the command line:
+
+    mcd43_export /data/MCD43A1 /data/export --a2-dir /data/MCD43A2 \\
+        --tiles h17v05 h18v04 --bands 1 2 vis --start 2017-01-01 \\
+        --end 2017-12-31 --format zarr
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from .BRDF_descriptors import KERNEL_FILL, KERNEL_SCALE, QA_FILL
+from .BRDF_descriptors import RetrieveBRDFDescriptors, pack_mask
+from .BRDF_descriptors import process_masked_kernels_multiband
+from .BRDF_descriptors import process_time_input
+from .sinusoidal import N_PIXELS, SINUSOIDAL_WKT, parse_tile
+from .sinusoidal import pixel_geotransform
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+TIME_UNITS = "days since 1970-01-01"
+TIME_ORIGIN = datetime.datetime(1970, 1, 1)
+TIME_FILL = -1
+
+
+def _export_date(bands, a1_granule, a2_granule, band_transfer, roi):
+    """Reads the bands of a date, as stored in the exports."""
+    kernels, mask, qa = process_masked_kernels_multiband(
+        bands, a1_granule, a2_granule, band_transfer=band_transfer,
+        roi=roi, raw=True)
+    qa = np.where(mask, qa, QA_FILL).astype(np.uint8)
+    return kernels, pack_mask(mask), qa
+
+
+class _Export(object):
+    """Common parts of the exporters. Dates are buffered, and written
+    out `chunk_time` at a time by `_write`, with their times written
+    last, so that an interrupted write is overwritten on restart."""
+
+    extension = None
+
+    def __init__(self, fname, bands, shape, chunk_time=8, chunk_size=128,
+                 attrs=None):
+        self.fname = fname
+        self.bands = [str(band_no) for band_no in bands]
+        self.shape = tuple(shape)
+        self.chunk_time = chunk_time
+        self.chunk_size = chunk_size
+        self.attrs = {} if attrs is None else attrs
+        self._buffer = []
+        self.dates = self._open()
+
+    def _chunks(self, name):
+        ny, nx = self.shape
+        cy, cx = min(self.chunk_size, ny), min(self.chunk_size, nx)
+        if name.startswith("kernels_"):
+            return (self.chunk_time, 3, cy, cx)
+        elif name.startswith("mask_"):
+            return (self.chunk_time, cy, -(-cx // 8))
+        return (self.chunk_time, cy, cx)
+
+    def _variables(self):
+        """Returns the (name, dtype, fill value, attributes) of the
+        variables of each band."""
+        variables = []
+        for band_no in self.bands:
+            variables.append(("kernels_%s" % band_no, np.int16,
+                              KERNEL_FILL,
+                              {"scale_factor": KERNEL_SCALE,
+                               "long_name": "BRDF kernel weights " +
+                               "(isotropic, volumetric, geometric)"}))
+            variables.append(("mask_%s" % band_no, np.uint8, 0,
+                              {"long_name": "Valid pixels, packed " +
+                               "along x (see BRDF_descriptors.unpack_mask)",
+                               "n_cols": self.shape[1]}))
+            variables.append(("qa_%s" % band_no, np.uint8, QA_FILL,
+                              {"long_name": "MCD43 band QA"}))
+        return variables
+
+    def append(self, date, kernels, mask, qa):
+        """Adds a date's (band, 3, y, x) kernels, (band, y, x_packed)
+        packed mask and (band, y, x) QA."""
+        self._buffer.append((date, kernels, mask, qa))
+        if len(self._buffer) >= self.chunk_time:
+            self.flush()
+
+    def flush(self):
+        """Writes out the buffered dates."""
+        if not self._buffer:
+            return
+        dates, kernels, mask, qa = zip(*self._buffer)
+        days = np.array([(date - TIME_ORIGIN).days for date in dates],
+                        dtype=np.int32)
+        data = {}
+        for i, band_no in enumerate(self.bands):
+            data["kernels_%s" % band_no] = np.stack([k[i] for k in kernels])
+            data["mask_%s" % band_no] = np.stack([m[i] for m in mask])
+            data["qa_%s" % band_no] = np.stack([q[i] for q in qa])
+        self._write(len(self.dates), data, days)
+        self.dates.extend(dates)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._close()
+
+
+class NetCDFExport(_Export):
+    """Exports to a NetCDF4 file, with zlib compressed variables."""
+
+    extension = ".nc"
+
+    def _open(self):
+        if netCDF4 is None:
+            raise ImportError("The netCDF4 package is needed to write " +
+                              "NetCDF files")
+        exists = os.path.exists(self.fname)
+        self.ds = netCDF4.Dataset(self.fname, "a" if exists else "w")
+        if not exists:
+            ny, nx = self.shape
+            self.ds.createDimension("time", None)
+            self.ds.createDimension("kernel", 3)
+            self.ds.createDimension("y", ny)
+            self.ds.createDimension("x", nx)
+            self.ds.createDimension("x_packed", -(-nx // 8))
+            time = self.ds.createVariable("time", np.int32, ("time",),
+                                          fill_value=TIME_FILL)
+            time.units = TIME_UNITS
+            time.calendar = "standard"
+            for name, dtype, fill, attrs in self._variables():
+                dims = ("time", "y", "x")
+                if name.startswith("kernels_"):
+                    dims = ("time", "kernel", "y", "x")
+                elif name.startswith("mask_"):
+                    dims = ("time", "y", "x_packed")
+                var = self.ds.createVariable(name, dtype, dims, zlib=True,
+                                             complevel=4, shuffle=True,
+                                             chunksizes=self._chunks(name),
+                                             fill_value=fill)
+                var.setncatts(attrs)
+            self.ds.setncatts(self.attrs)
+        # Raw values are written as they are: this only applies to the
+        # variables that already exist, so it has to come after them
+        self.ds.set_auto_maskandscale(False)
+        # Only the dates before the first missing time were completed
+        days = self.ds["time"][:]
+        n_dates = len(days) if np.all(days != TIME_FILL) \
+            else int(np.argmax(days == TIME_FILL))
+        return [TIME_ORIGIN + datetime.timedelta(days=int(day))
+                for day in days[:n_dates]]
+
+    def _write(self, start, data, days):
+        end = start + len(days)
+        for name, values in data.items():
+            self.ds[name][start:end] = values
+        self.ds["time"][start:end] = days
+        self.ds.sync()
+
+    def _close(self):
+        self.ds.close()
+
+
+class ZarrExport(_Export):
+    """Exports to a Zarr store, with the default Zarr compressor."""
+
+    extension = ".zarr"
+
+    def _open(self):
+        if zarr is None:
+            raise ImportError("The zarr package is needed to write " +
+                              "Zarr stores")
+        self.group = zarr.open_group(self.fname, mode="a")
+        create = getattr(self.group, "create_array", None) or \
+            self.group.create_dataset
+        if "time" not in self.group:
+            ny, nx = self.shape
+            time = create("time", shape=(0,), dtype=np.int32,
+                          chunks=(self.chunk_time,), fill_value=TIME_FILL)
+            time.attrs.update({"units": TIME_UNITS,
+                               "calendar": "standard"})
+            for name, dtype, fill, attrs in self._variables():
+                shape = (0, ny, nx)
+                if name.startswith("kernels_"):
+                    shape = (0, 3, ny, nx)
+                elif name.startswith("mask_"):
+                    shape = (0, ny, -(-nx // 8))
+                array = create(name, shape=shape, dtype=dtype,
+                               chunks=self._chunks(name), fill_value=fill)
+                array.attrs.update(attrs)
+            self.group.attrs.update(self.attrs)
+        # Drop anything written after the last completed time
+        days = self.group["time"][:]
+        if np.any(days == TIME_FILL):
+            days = days[:int(np.argmax(days == TIME_FILL))]
+            self.group["time"].resize((len(days),))
+        for name, _, _, _ in self._variables():
+            array = self.group[name]
+            if array.shape[0] != len(days):
+                array.resize((len(days),) + array.shape[1:])
+        return [TIME_ORIGIN + datetime.timedelta(days=int(day))
+                for day in days]
+
+    def _write(self, start, data, days):
+        end = start + len(days)
+        for name, values in data.items():
+            array = self.group[name]
+            array.resize((end,) + array.shape[1:])
+            array[start:end] = values
+        time = self.group["time"]
+        time.resize((end,))
+        time[start:end] = days
+
+    def _close(self):
+        pass
+
+
+EXPORTERS = {"netcdf": NetCDFExport, "zarr": ZarrExport}
+
+
+def export_tile(output_dir, tile, mcd43a1_dir, bands, start_time,
+                end_time=None, mcd43a2_dir=None, roi=None,
+                fmt="netcdf", n_workers=None, chunk_time=8,
+                chunk_size=128):
+    """Exports the time series of a tile (or of a `roi` within it) for
+    several bands to `output_dir/MCD43_<tile>.nc` (or `.zarr`, see
+    `EXPORTERS`), reading dates with a pool of `n_workers` processes.
+    Dates already in the output are skipped, and dates are appended in
+    the order they are read, so the time axis is only sorted if the
+    archive isn't back filled between runs. Returns the output file
+    name and the number of dates written."""
+    bands = list(bands)
+    retriever = RetrieveBRDFDescriptors(tile, mcd43a1_dir, start_time,
+                                        end_time=end_time,
+                                        mcd43a2_dir=mcd43a2_dir, roi=roi)
+    dates = sorted(retriever.a1_granules.keys())
+    if len(dates) == 0:
+        raise ValueError("No granules to export for %s!" % tile)
+    ny, nx = retriever._output_shape(bands[0], dates[0])
+    ulx, uly = (0, 0) if roi is None else roi[:2]
+    h, v = parse_tile(tile)
+    attrs = {"tile": tile, "roi": [ulx, uly, ulx + nx, uly + ny],
+             "bands": [str(band_no) for band_no in bands],
+             "geotransform": list(pixel_geotransform(v * N_PIXELS + uly,
+                                                     h * N_PIXELS + ulx)),
+             "crs_wkt": SINUSOIDAL_WKT}
+    os.makedirs(output_dir, exist_ok=True)
+    exporter = EXPORTERS[fmt]
+    fname = os.path.join(output_dir,
+                         "MCD43_%s%s" % (tile, exporter.extension))
+    writer = exporter(fname, bands, (ny, nx), chunk_time=chunk_time,
+                      chunk_size=chunk_size, attrs=attrs)
+    n_written = 0
+    try:
+        done = set(writer.dates)
+        pending = iter([date for date in dates if date not in done])
+        n_workers = n_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # Keep a bounded number of dates in flight, and write them
+            # in order as they complete
+            in_flight = deque()
+
+            def submit():
+                for date in pending:
+                    in_flight.append((date, executor.submit(
+                        _export_date, bands, retriever.a1_granules[date],
+                        retriever.a2_granules[date],
+                        retriever.band_transfer, roi)))
+                    return
+
+            for _ in range(2 * n_workers):
+                submit()
+            while in_flight:
+                date, future = in_flight.popleft()
+                writer.append(date, *future.result())
+                n_written += 1
+                submit()
+    finally:
+        writer.close()
+    return fname, n_written
+
+
+def _band(band_no):
+    return int(band_no) if band_no.isdigit() else band_no
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export MCD43 tile time series to chunked " +
+        "NetCDF4 or Zarr stores")
+    parser.add_argument("mcd43a1_dir", help="Folder with the MCD43A1 " +
+                        "granules")
+    parser.add_argument("output_dir", help="Folder for the exports")
+    parser.add_argument("--a2-dir", default=None,
+                        help="Folder with the MCD43A2 granules " +
+                        "(defaults to mcd43a1_dir)")
+    parser.add_argument("--tiles", nargs="+", required=True,
+                        help="MODIS tiles, e.g. h17v05")
+    parser.add_argument("--bands", nargs="+", type=_band,
+                        default=[1, 2, 3, 4, 5, 6, 7],
+                        help="Bands (1 to 7, vis, nir or shortwave)")
+    parser.add_argument("--start", required=True,
+                        help="Start date (%%Y-%%m-%%d or %%Y%%j)")
+    parser.add_argument("--end", default=None,
+                        help="End date (defaults to the latest granule)")
+    parser.add_argument("--roi", nargs=4, type=int, default=None,
+                        metavar=("ULX", "ULY", "LRX", "LRY"),
+                        help="Pixel window within each tile")
+    parser.add_argument("--format", choices=sorted(EXPORTERS),
+                        default="netcdf", help="Output format")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of reading processes " +
+                        "(defaults to the number of cores)")
+    parser.add_argument("--chunk-time", type=int, default=8,
+                        help="Dates per chunk")
+    parser.add_argument("--chunk-size", type=int, default=128,
+                        help="Rows and columns per chunk")
+    args = parser.parse_args(argv)
+
+    start_time = process_time_input(args.start)
+    end_time = None if args.end is None else process_time_input(args.end)
+    for tile in args.tiles:
+        fname, n_written = export_tile(
+            args.output_dir, tile, args.mcd43a1_dir, args.bands,
+            start_time, end_time=end_time, mcd43a2_dir=args.a2_dir,
+            roi=args.roi, fmt=args.format, n_workers=args.workers,
+            chunk_time=args.chunk_time, chunk_size=args.chunk_size)
+        print("%s: %d dates written to %s" % (tile, n_written, fname))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Instrumentation of the read pipeline.
+
+The hot paths of the package (directory scanning, `gdal.Open`,
+`ReadAsArray`, kernel decoding and mask building) report what they do
+to the probes registered with `add_probe`. A probe is any callable
+taking `(stage, seconds, nbytes, n_arrays, layer)`, where `stage` is one
+of `STAGES`, `nbytes` the number of bytes read or produced, `n_arrays`
+the number of arrays allocated, and `layer` the file or GDAL subdataset
+involved (or None). Probes are called from whatever thread does the
+work, so they need to be thread safe.
+
+When no probes are registered, the only cost is checking whether the
+probe list is empty. `instrument` is a context manager that collects a
+`ReadProfile` report, e.g.
+
+    with instrument() as profile:
+        retriever.get_brdf_descriptors(1, "2017-01-01")
+    print(profile.report())
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+STAGES = ["scan", "open", "read", "decode", "mask"]
+
+# The registered probes. Hot paths check it before taking any timings.
+PROBES = []
+
+_probes_lock = threading.Lock()
+_granule_regex = re.compile(r'"([^"]*)"')
+
+
+def add_probe(probe):
+    """Registers a probe, called as `probe(stage, seconds, nbytes,
+    n_arrays, layer)` by every instrumented stage."""
+    with _probes_lock:
+        PROBES.append(probe)
+
+
+def remove_probe(probe):
+    """Unregisters a probe added with `add_probe`."""
+    with _probes_lock:
+        PROBES.remove(probe)
+
+
+def record(stage, t0, nbytes=0, n_arrays=0, layer=None):
+    """Reports a stage that started at `t0` (a `time.perf_counter`
+    value) to all the registered probes."""
+    seconds = time.perf_counter() - t0
+    for probe in list(PROBES):
+        probe(stage, seconds, nbytes, n_arrays, layer)
+
+
+def layer_granule(layer):
+    """Returns the granule file name of a GDAL subdataset name (the
+    quoted part of e.g. 'HDF4_EOS:EOS_GRID:"file.hdf":...')."""
+    match = _granule_regex.search(layer)
+    return layer if match is None else match.group(1)
+
+
+class ReadProfile(object):
+    """A probe that accumulates the number of calls, time, bytes and
+    arrays allocated per stage, and the layers and granules touched.
+    Stage times are summed over all the threads doing the work, so with
+    threaded reads they can add up to more than the wall time. An
+    optional `callback` is also called with every event."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}
+        self.layers = set()
+        self.start = time.perf_counter()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, seconds, nbytes, n_arrays, layer):
+        with self._lock:
+            counts = self.stages.setdefault(stage, [0, 0., 0, 0])
+            counts[0] += 1
+            counts[1] += seconds
+            counts[2] += nbytes
+            counts[3] += n_arrays
+            if layer is not None:
+                self.layers.add(layer)
+        if self.callback is not None:
+            self.callback(stage, seconds, nbytes, n_arrays, layer)
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    def report(self):
+        """Returns a dictionary with the wall time, the per stage
+        statistics, the total bytes read by GDAL and arrays allocated,
+        and the granules touched."""
+        with self._lock:
+            stages = {stage: {"calls": calls, "seconds": seconds,
+                              "bytes": nbytes, "arrays": n_arrays}
+                      for stage, (calls, seconds, nbytes, n_arrays)
+                      in self.stages.items()}
+            layers = set(self.layers)
+        end = time.perf_counter() if self.end is None else self.end
+        granules = sorted(set(layer_granule(layer) for layer in layers))
+        return {"wall_time": end - self.start,
+                "stages": stages,
+                "bytes_read": stages.get("read", {}).get("bytes", 0),
+                "arrays_allocated": sum(stage["arrays"]
+                                        for stage in stages.values()),
+                "granules": granules,
+                "n_granules": len(granules)}
+
+
+@contextmanager
+def instrument(callback=None):
+    """Collects a `ReadProfile` of everything read while the context is
+    active (in any thread). `callback`, if given, is called with every
+    event as it happens."""
+    profile = ReadProfile(callback=callback)
+    add_probe(profile)
+    try:
+        yield profile
+    finally:
+        remove_probe(profile)
+        profile.stop()
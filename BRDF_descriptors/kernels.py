@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Vectorised MODIS linear BRDF kernels. The MCD43 kernel weights
+returned by `RetrieveBRDFDescriptors` are the isotropic, volumetric
+(Ross-Thick) and geometric (Li-Sparse Reciprocal) kernel weights, and
+can be turned into reflectance for any acquisition geometry with
+`predict_reflectance`.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+# MODIS Li-Sparse Reciprocal crown shape parameters
+HB_RATIO = 2.
+BR_RATIO = 1.
+
+# Maximum size (in bytes) of the memoised kernel values
+MEMO_BYTES = 256 * 1024**2
+_memo = OrderedDict()
+_memo_nbytes = [0]
+_memo_lock = threading.Lock()
+
+
+def ross_thick(sza, vza, raa):
+    """Ross-Thick volumetric kernel. Angles are given in degrees."""
+    sza = np.radians(sza)
+    vza = np.radians(vza)
+    raa = np.radians(raa)
+    cos_xi = np.cos(sza) * np.cos(vza) + \
+        np.sin(sza) * np.sin(vza) * np.cos(raa)
+    cos_xi = np.clip(cos_xi, -1., 1.)
+    xi = np.arccos(cos_xi)
+    return ((np.pi / 2. - xi) * cos_xi + np.sin(xi)) / \
+        (np.cos(sza) + np.cos(vza)) - np.pi / 4.
+
+
+def li_sparse(sza, vza, raa, hb=HB_RATIO, br=BR_RATIO):
+    """Li-Sparse Reciprocal geometric kernel. Angles are given in
+    degrees."""
+    raa = np.radians(raa)
+    # Equivalent angles for spheroidal crowns
+    tan_s = br * np.tan(np.radians(sza))
+    tan_v = br * np.tan(np.radians(vza))
+    sza = np.arctan(tan_s)
+    vza = np.arctan(tan_v)
+    sec_s = 1. / np.cos(sza)
+    sec_v = 1. / np.cos(vza)
+    cos_xi = np.cos(sza) * np.cos(vza) + \
+        np.sin(sza) * np.sin(vza) * np.cos(raa)
+    d2 = tan_s * tan_s + tan_v * tan_v - 2. * tan_s * tan_v * np.cos(raa)
+    cos_t = hb * np.sqrt(np.maximum(d2, 0.) +
+                         (tan_s * tan_v * np.sin(raa)) ** 2) / \
+        (sec_s + sec_v)
+    t = np.arccos(np.clip(cos_t, -1., 1.))
+    overlap = (t - np.sin(t) * np.cos(t)) * (sec_s + sec_v) / np.pi
+    return overlap - sec_s - sec_v + 0.5 * (1. + cos_xi) * sec_s * sec_v
+
+
+def _memo_key(sza, vza, raa):
+    """Keys the geometry on the shape, dtype and a digest of the data
+    of each angle, hashed in place for contiguous arrays."""
+    key = []
+    for angle in (sza, vza, raa):
+        angle = np.ascontiguousarray(angle)
+        key.append((angle.shape, angle.dtype.str,
+                    hashlib.blake2b(angle, digest_size=16).digest()))
+    return tuple(key)
+
+
+def kernel_values(sza, vza, raa):
+    """Returns the volumetric and geometric kernel values for arrays of
+    solar zenith, view zenith and relative azimuth angles (in degrees),
+    broadcast against each other. Results for the most recently used
+    geometries are memoised (up to `MEMO_BYTES`), so repeated calls
+    with the same geometry are cheap. The returned arrays are
+    read-only."""
+    key = _memo_key(sza, vza, raa)
+    with _memo_lock:
+        try:
+            _memo.move_to_end(key)
+            return _memo[key]
+        except KeyError:
+            pass
+    k_vol = np.asarray(ross_thick(sza, vza, raa))
+    k_geo = np.asarray(li_sparse(sza, vza, raa))
+    k_vol.setflags(write=False)
+    k_geo.setflags(write=False)
+    nbytes = k_vol.nbytes + k_geo.nbytes
+    if nbytes > MEMO_BYTES:
+        return k_vol, k_geo
+    with _memo_lock:
+        if key in _memo:
+            _memo_nbytes[0] -= sum(k.nbytes for k in _memo.pop(key))
+        _memo[key] = (k_vol, k_geo)
+        _memo_nbytes[0] += nbytes
+        while _memo_nbytes[0] > MEMO_BYTES:
+            _, evicted = _memo.popitem(last=False)
+            _memo_nbytes[0] -= sum(k.nbytes for k in evicted)
+    return k_vol, k_geo
+
+
+def clear_memo():
+    """Forgets all the memoised kernel values."""
+    with _memo_lock:
+        _memo.clear()
+        _memo_nbytes[0] = 0
+
+
+def predict_reflectance(kernels, geometry):
+    """Forward models reflectance from an array of kernel weights with
+    the kernels on the third to last axis, as returned by
+    `RetrieveBRDFDescriptors` (e.g. (3, y, x) or (time, 3, y, x)).
+    `geometry` is a (sza, vza, raa) tuple of angles in degrees, each of
+    which must broadcast against the kernels array without its kernel
+    axis (e.g. scalars, (y, x) or (time, y, x) arrays). Masked (NaN)
+    kernel weights result in NaN reflectance."""
+    kernels = np.asarray(kernels)
+    if kernels.ndim < 3 or kernels.shape[-3] != 3:
+        raise ValueError("Kernels need to be a (..., 3, y, x) array!")
+    k_vol, k_geo = kernel_values(*geometry)
+    reflectance = kernels[..., 1, :, :] * k_vol
+    reflectance += kernels[..., 0, :, :]
+    reflectance += kernels[..., 2, :, :] * k_geo
+    return reflectance
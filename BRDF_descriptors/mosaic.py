@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Retrieving BRDF descriptors for a geographic area of interest, which
+might straddle several MODIS tiles. Only the windows of each tile that
+cover the area are read, and they are mosaicked into a single array on
+the sinusoidal grid.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .BRDF_descriptors import RetrieveBRDFDescriptors, process_time_input
+from .sinusoidal import SINUSOIDAL_WKT, bbox_to_polygon, pixel_geotransform
+from .sinusoidal import polygon_mask, polygon_windows
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+
+class MosaicBRDFDescriptors(object):
+    """Retrieving BRDF descriptors over a geographic area."""
+
+    def __init__(self, mcd43a1_dir, start_time, end_time=None,
+                 mcd43a2_dir=None, bbox=None, polygon=None, n_threads=4,
+                 **kwargs):
+        """The area of interest is given either as a `bbox` of
+        (lon_min, lat_min, lon_max, lat_max), or as a `polygon` of
+        (lon, lat) vertices, in which case pixels outside of it are
+        masked out. A `RetrieveBRDFDescriptors` object is set up for the
+        window of each tile that covers the area (tiles with no granules
+        are skipped), and further keyword arguments are passed on to
+        them. Only the dates available for all the tiles are used, and
+        tiles are read in parallel by `n_threads` threads. The
+        geotransform and projection of the mosaic are available as the
+        `geotransform` and `projection` attributes."""
+        if (bbox is None) == (polygon is None):
+            raise ValueError("Either a bbox or a polygon are needed!")
+        self.polygon = None
+        if bbox is not None:
+            polygon = bbox_to_polygon(*bbox)
+        else:
+            self.polygon = polygon
+        (row0, col0), self.shape, windows = polygon_windows(polygon)
+        self.geotransform = pixel_geotransform(row0, col0)
+        self.projection = SINUSOIDAL_WKT
+        self.n_threads = n_threads
+        self.tiles = []
+        for tile, roi, offset in windows:
+            try:
+                retriever = RetrieveBRDFDescriptors(
+                    tile, mcd43a1_dir, start_time, end_time=end_time,
+                    mcd43a2_dir=mcd43a2_dir, roi=roi, **kwargs)
+            except IOError:
+                continue
+            self.tiles.append((retriever, offset))
+        if len(self.tiles) == 0:
+            raise IOError("Couldn't find granules for any of the tiles!")
+        dates = set(self.tiles[0][0].a1_granules.keys())
+        for retriever, _ in self.tiles[1:]:
+            dates &= set(retriever.a1_granules.keys())
+        self.dates = sorted(dates)
+        if self.polygon is not None:
+            self.inside = polygon_mask(self.polygon, self.geotransform,
+                                       self.shape)
+        else:
+            self.inside = None
+
+    def get_brdf_descriptors(self, band_no, date):
+        """Retrieves the mosaicked (3, y, x) kernels and (y, x) mask and
+        QA for a band on a given date, or None if the date isn't
+        available for all the tiles. Pixels not covered by any tile are
+        masked out."""
+        the_date = process_time_input(date)
+        if the_date not in self.dates:
+            return None
+        dtype = self.tiles[0][0].dtype
+        kernels = np.full((3,) + tuple(self.shape), np.nan, dtype=dtype)
+        mask = np.zeros(self.shape, dtype=bool)
+        qa = np.full(self.shape, np.nan, dtype=dtype)
+
+        def read_tile(tile):
+            retriever, (row, col) = tile
+            tile_kernels, tile_mask, tile_qa = \
+                retriever.get_brdf_descriptors(band_no, the_date)
+            window = (slice(row, row + tile_mask.shape[0]),
+                      slice(col, col + tile_mask.shape[1]))
+            kernels[(slice(None),) + window] = tile_kernels
+            mask[window] = tile_mask
+            qa[window] = tile_qa
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            list(executor.map(read_tile, self.tiles))
+        if self.inside is not None:
+            mask &= self.inside
+            kernels[:, ~self.inside] = np.nan
+            qa[~self.inside] = np.nan
+        return kernels, mask, qa
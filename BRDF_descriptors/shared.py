@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""Sharing descriptor arrays with worker processes without copying them.
+
+Passing the kernels, mask and QA of a tile to a pool of worker
+processes pickles them through a pipe, copying them for every worker.
+Instead, a `SharedArrays` object (owned by the parent process) holds
+arrays in `multiprocessing.shared_memory` blocks, and hands out
+`SharedArray` descriptors (the name, shape and dtype of each block),
+which are cheap to pickle. Workers map the same memory with
+`attach_shared`, e.g.
+
+    def invert(descriptors):
+        kernels, mask, qa = attach_shared(descriptors)
+        ...
+
+    with SharedArrays() as shared:
+        descriptors = retriever.get_brdf_descriptors(1, date,
+                                                     shared=shared)
+        pool.map(invert, [descriptors] * n_workers)
+
+The parent process owns the blocks, and unlinks them when the
+`SharedArrays` object is closed (or its context exits). Each process
+unmaps a block once the arrays (and views) using it are gone.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import weakref
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype"])
+SharedArray.__doc__ = """Descriptor of an array held in a shared memory
+block: the block `name`, the array `shape` and its `dtype` string."""
+
+
+def _open_block(name):
+    """Opens an existing block without registering it with the resource
+    tracker (where supported), as it belongs to another process."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedArrays(object):
+    """A set of numpy arrays in shared memory blocks, owned by the
+    calling process. Blocks live until they are released with `release`,
+    or all of them with `close`, which is also called when leaving the
+    object's context. Releasing a block only removes its name, so that
+    no more processes can attach to it: the memory itself is freed once
+    no process uses it any longer."""
+
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def empty(self, shape, dtype):
+        """Allocates an uninitialised array in a new shared memory
+        block. Returns the array and its `SharedArray` descriptor."""
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(nbytes, 1))
+        with self._lock:
+            self._blocks[block.name] = block
+        data = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        weakref.finalize(data, block.close)
+        return data, SharedArray(block.name, shape, dtype.str)
+
+    def release(self, descriptors):
+        """Frees the blocks of one or several `SharedArray`
+        descriptors."""
+        if isinstance(descriptors, SharedArray):
+            descriptors = [descriptors]
+        for descriptor in descriptors:
+            with self._lock:
+                block = self._blocks.pop(descriptor.name, None)
+            if block is not None:
+                block.unlink()
+
+    def close(self):
+        """Frees all the blocks."""
+        with self._lock:
+            blocks = list(self._blocks.values())
+            self._blocks.clear()
+        for block in blocks:
+            block.unlink()
+
+
+def attach_shared(descriptors):
+    """Maps the arrays of a `SharedArray` descriptor (or a sequence of
+    them) created by another process, without copying them. Returns
+    the array (or a tuple of arrays). The blocks are unmapped when the
+    arrays are garbage collected."""
+    if isinstance(descriptors, SharedArray):
+        return attach_shared([descriptors])[0]
+    arrays = []
+    for descriptor in descriptors:
+        block = _open_block(descriptor.name)
+        data = np.ndarray(descriptor.shape,
+                          dtype=np.dtype(descriptor.dtype),
+                          buffer=block.buf)
+        # The finalizer keeps the block open for as long as the array
+        weakref.finalize(data, block.close)
+        arrays.append(data)
+    return tuple(arrays)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""Conversions between geographic coordinates and the MODIS sinusoidal
+tile grid. The grid is made of 36 x 18 tiles (named e.g. "h17v05"),
+each of 2400 x 2400 pixels for the 500 m MCD43 products.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+import numpy as np
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+EARTH_RADIUS = 6371007.181
+TILE_SIZE = 1111950.5197665233
+X_MIN = -20015109.355797
+Y_MAX = 10007554.677899
+N_PIXELS = 2400
+
+SINUSOIDAL_WKT = ('PROJCS["unnamed",GEOGCS["Unknown datum based upon the ' +
+                  'custom spheroid",DATUM["Not specified (based on ' +
+                  'custom spheroid)",SPHEROID["Custom spheroid",' +
+                  '6371007.181,0]],PRIMEM["Greenwich",0],' +
+                  'UNIT["degree",0.0174532925199433]],' +
+                  'PROJECTION["Sinusoidal"],' +
+                  'PARAMETER["longitude_of_center",0],' +
+                  'PARAMETER["false_easting",0],' +
+                  'PARAMETER["false_northing",0],UNIT["Meter",1]]')
+
+
+def parse_tile(tile):
+    """Returns the (h, v) numbers of a tile name such as "h17v05"."""
+    match = re.match(r"^h(\d{2})v(\d{2})$", tile)
+    if match is None:
+        raise ValueError("%s isn't a valid MODIS tile name" % tile)
+    return int(match.group(1)), int(match.group(2))
+
+
+def latlon_to_sinusoidal(lat, lon):
+    """Converts latitude and longitude (in degrees) to sinusoidal x and
+    y (in metres)."""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    x = EARTH_RADIUS * lon * np.cos(lat)
+    y = EARTH_RADIUS * lat
+    return x, y
+
+
+def sinusoidal_to_latlon(x, y):
+    """Converts sinusoidal x and y (in metres) to latitude and longitude
+    (in degrees)."""
+    lat = np.asarray(y) / EARTH_RADIUS
+    lon = np.asarray(x) / (EARTH_RADIUS * np.cos(lat))
+    return np.degrees(lat), np.degrees(lon)
+
+
+def tile_geotransform(tile, n_pixels=N_PIXELS):
+    """Returns the GDAL geotransform of a tile."""
+    h, v = parse_tile(tile)
+    pixel_size = TILE_SIZE / n_pixels
+    return (X_MIN + h * TILE_SIZE, pixel_size, 0.,
+            Y_MAX - v * TILE_SIZE, 0., -pixel_size)
+
+
+def pixel_geotransform(row, col, n_pixels=N_PIXELS):
+    """Returns the GDAL geotransform of a grid whose upper left corner is
+    at a given (row, col) in global pixel coordinates."""
+    pixel_size = TILE_SIZE / n_pixels
+    return (X_MIN + col * pixel_size, pixel_size, 0.,
+            Y_MAX - row * pixel_size, 0., -pixel_size)
+
+
+def sinusoidal_to_tile_pixel(x, y, n_pixels=N_PIXELS):
+    """Converts sinusoidal x and y to the tile (h, v) numbers and the
+    pixel row and column within the tile. Returns arrays of h, v, row
+    and col."""
+    pixel_size = TILE_SIZE / n_pixels
+    col_global = np.floor((np.asarray(x) - X_MIN) / pixel_size).astype(int)
+    row_global = np.floor((Y_MAX - np.asarray(y)) / pixel_size).astype(int)
+    h, col = np.divmod(col_global, n_pixels)
+    v, row = np.divmod(row_global, n_pixels)
+    return h, v, row, col
+
+
+def latlon_to_tile_pixel(lat, lon, tile=None, n_pixels=N_PIXELS):
+    """Converts latitude and longitude to pixel rows and columns. If
+    `tile` is given, rows and columns are relative to it (and might be
+    outside of it), otherwise, the tile names of each location are also
+    returned as an array."""
+    x, y = latlon_to_sinusoidal(lat, lon)
+    if tile is not None:
+        h0, v0 = parse_tile(tile)
+        h, v, row, col = sinusoidal_to_tile_pixel(x, y, n_pixels=n_pixels)
+        return row + (v - v0) * n_pixels, col + (h - h0) * n_pixels
+    h, v, row, col = sinusoidal_to_tile_pixel(x, y, n_pixels=n_pixels)
+    tiles = np.array(["h%02dv%02d" % (hh, vv) for hh, vv in
+                      zip(np.atleast_1d(h), np.atleast_1d(v))])
+    return tiles, row, col
+
+
+def sinusoidal_windows(x_min, y_min, x_max, y_max, n_pixels=N_PIXELS):
+    """Splits a sinusoidal extent (in metres) into per tile windows.
+    Returns the (row, col) of the upper left corner of the extent in
+    global pixel coordinates, its (n_rows, n_cols) shape, and a list of
+    (tile, (ulx, uly, lrx, lry), (row, col)) tuples, with the window in
+    pixel coordinates of each tile, and its offset in the extent."""
+    pixel_size = TILE_SIZE / n_pixels
+    col0 = int(np.floor((x_min - X_MIN) / pixel_size))
+    col1 = int(np.ceil((x_max - X_MIN) / pixel_size))
+    row0 = int(np.floor((Y_MAX - y_max) / pixel_size))
+    row1 = int(np.ceil((Y_MAX - y_min) / pixel_size))
+    col0, col1 = max(col0, 0), min(col1, 36 * n_pixels)
+    row0, row1 = max(row0, 0), min(row1, 18 * n_pixels)
+    windows = []
+    for v in range(row0 // n_pixels, (row1 - 1) // n_pixels + 1):
+        for h in range(col0 // n_pixels, (col1 - 1) // n_pixels + 1):
+            uly = max(row0, v * n_pixels)
+            lry = min(row1, (v + 1) * n_pixels)
+            ulx = max(col0, h * n_pixels)
+            lrx = min(col1, (h + 1) * n_pixels)
+            windows.append(("h%02dv%02d" % (h, v),
+                            (ulx - h * n_pixels, uly - v * n_pixels,
+                             lrx - h * n_pixels, lry - v * n_pixels),
+                            (uly - row0, ulx - col0)))
+    return (row0, col0), (row1 - row0, col1 - col0), windows
+
+
+def _densify(lons, lats, n_points=64):
+    """Adds points along the edges of a closed lon/lat ring, as straight
+    lines in lon/lat are curves in the sinusoidal projection."""
+    lons = np.append(lons, lons[0])
+    lats = np.append(lats, lats[0])
+    t = np.linspace(0., 1., n_points, endpoint=False)
+    dense_lons = (lons[:-1, None] + np.diff(lons)[:, None] * t).ravel()
+    dense_lats = (lats[:-1, None] + np.diff(lats)[:, None] * t).ravel()
+    return dense_lons, dense_lats
+
+
+def polygon_windows(polygon, n_pixels=N_PIXELS):
+    """Like `sinusoidal_windows`, but for the extent covered by a
+    polygon, given as a sequence of (lon, lat) vertices (see
+    `bbox_to_polygon` for bounding boxes)."""
+    lons, lats = np.asarray(polygon, dtype=np.float64).T
+    x, y = latlon_to_sinusoidal(*_densify(lons, lats)[::-1])
+    return sinusoidal_windows(x.min(), y.min(), x.max(), y.max(),
+                              n_pixels=n_pixels)
+
+
+def bbox_to_polygon(lon_min, lat_min, lon_max, lat_max):
+    """Returns the (lon, lat) vertices of a bounding box."""
+    return [(lon_min, lat_min), (lon_max, lat_min), (lon_max, lat_max),
+            (lon_min, lat_max)]
+
+
+def polygon_mask(polygon, geotransform, shape):
+    """Returns a (n_rows, n_cols) mask of the pixels of a sinusoidal
+    grid (given by its geotransform) whose centres fall within a
+    polygon of (lon, lat) vertices."""
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]] + 0.5
+    x = geotransform[0] + cols * geotransform[1]
+    y = geotransform[3] + rows * geotransform[5]
+    lat, lon = sinusoidal_to_latlon(x, y)
+    vertices = np.asarray(polygon, dtype=np.float64)
+    inside = np.zeros(shape, dtype=bool)
+    # Even-odd rule ray casting, one edge at a time
+    for (lon0, lat0), (lon1, lat1) in zip(vertices,
+                                          np.roll(vertices, -1, axis=0)):
+        if lat0 == lat1:
+            continue
+        crosses = (lat0 > lat) != (lat1 > lat)
+        lon_cross = lon0 + (lat - lat0) * (lon1 - lon0) / (lat1 - lat0)
+        inside ^= crosses & (lon < lon_cross)
+    return inside
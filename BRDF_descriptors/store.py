@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""A local, memory-mappable store of MCD43 time series.
+
+Reading small windows from the MCD43 HDF4 granules through GDAL is
+slow, as every read requires opening the granule and parsing its
+metadata. `convert_to_store` transcodes the A1/A2 time series of a tile
+once into a folder of raw .npy arrays with a (time, ...) layout:
+
+* `kernels_<band>.npy`: (time, 3, y, x) float32 scaled kernels.
+* `qa_<band>.npy`: (time, y, x) uint8 QA values (255 is fill).
+* `snow.npy`: (time, y, x) uint8 snow flags (0 for snow free).
+* `store.json`: the tile, ROI, bands and dates in the store.
+
+`MCD43Store` then reads from these arrays through memory maps, so
+windows and pixel time series are just views into the files.
+"""
+
+# KaFKA A fast Kalman filter implementation for raster based datasets.
+# Copyright (c) 2017 J Gomez-Dans. All rights reserved.
+#
+# This file is part of KaFKA.
+#
+# KaFKA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# KaFKA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KaFKA.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .BRDF_descriptors import process_time_input, process_kernels
+from .BRDF_descriptors import band_layers, granule_layer, open_gdal_dataset
+
+__author__ = "J Gomez-Dans"
+__copyright__ = "Copyright 2017, 2018 J Gomez-Dans"
+__license__ = "GPLv3"
+__email__ = "j.gomez-dans@ucl.ac.uk"
+
+STORE_METADATA = "store.json"
+
+
+def convert_to_store(store_dir, retriever, bands=(1, 2, 3, 4, 5, 6, 7),
+                     n_threads=4):
+    """Transcodes the time series available to a
+    `RetrieveBRDFDescriptors` object (for its tile and ROI) into a
+    memory-mappable store under `store_dir/<tile>`. Returns the path to
+    the store."""
+    dates = sorted(retriever.a1_granules.keys())
+    if len(dates) == 0:
+        raise ValueError("No granules to convert!")
+    bands = list(bands)
+    a1_granules = [retriever.a1_granules[date] for date in dates]
+    a2_granules = [retriever.a2_granules[date] for date in dates]
+    snow = open_gdal_dataset(granule_layer(a2_granules[0],
+                                           "Snow_BRDF_Albedo"),
+                             retriever.roi)
+    ny, nx = snow.shape
+    if retriever.roi is None:
+        roi = [0, 0, nx, ny]
+    else:
+        roi = list(retriever.roi)
+
+    store = Path(store_dir) / retriever.tile
+    store.mkdir(parents=True, exist_ok=True)
+    open_memmap = np.lib.format.open_memmap
+    snow = open_memmap((store / "snow.npy").as_posix(), mode="w+",
+                       dtype=np.uint8, shape=(len(dates), ny, nx))
+    kernels = {}
+    qa = {}
+    for band_no in bands:
+        kernels[band_no] = open_memmap(
+            (store / ("kernels_%s.npy" % band_no)).as_posix(), mode="w+",
+            dtype=np.float32, shape=(len(dates), 3, ny, nx))
+        qa[band_no] = open_memmap(
+            (store / ("qa_%s.npy" % band_no)).as_posix(), mode="w+",
+            dtype=np.uint8, shape=(len(dates), ny, nx))
+
+    def convert_date(i):
+        snow[i] = open_gdal_dataset(
+            granule_layer(a2_granules[i], "Snow_BRDF_Albedo"),
+            retriever.roi)
+        for band_no in bands:
+            band = band_no if retriever.band_transfer is None \
+                else retriever.band_transfer[band_no]
+            fdata, fqa = band_layers(band, a1_granules[i], a2_granules[i])
+            process_kernels(open_gdal_dataset(granule_layer(*fdata),
+                                              retriever.roi),
+                            out=kernels[band_no][i])
+            data = open_gdal_dataset(granule_layer(*fqa), retriever.roi)
+            qa[band_no][i] = data
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(convert_date, range(len(dates))))
+    for array in [snow] + list(kernels.values()) + list(qa.values()):
+        array.flush()
+    metadata = {"tile": retriever.tile, "roi": roi,
+                "bands": [str(band_no) for band_no in bands],
+                "dates": [date.strftime("%Y-%m-%d") for date in dates]}
+    with open((store / STORE_METADATA).as_posix(), "w") as fp:
+        json.dump(metadata, fp)
+    return store
+
+
+class MCD43Store(object):
+    """Reads kernels, masks and QA from a store written by
+    `convert_to_store`. All arrays are memory mapped, so the kernels
+    returned are read-only views into the store, unless they are asked
+    for as a `dtype` other than float32. The QA is returned as
+    `dtype`."""
+
+    def __init__(self, store_dir, tile):
+        self.store = Path(store_dir) / tile
+        with open((self.store / STORE_METADATA).as_posix()) as fp:
+            metadata = json.load(fp)
+        self.tile = metadata["tile"]
+        self.roi = metadata["roi"]
+        self.bands = metadata["bands"]
+        self.dates = [datetime.datetime.strptime(date, "%Y-%m-%d")
+                      for date in metadata["dates"]]
+        self._date_index = {date: i for i, date in enumerate(self.dates)}
+        self._arrays = {}
+
+    @classmethod
+    def exists(cls, store_dir, tile):
+        """Returns True if there's a store for `tile` in `store_dir`."""
+        return (Path(store_dir) / tile / STORE_METADATA).exists()
+
+    def has_band(self, band_no):
+        return str(band_no) in self.bands
+
+    def _array(self, name):
+        try:
+            return self._arrays[name]
+        except KeyError:
+            array = np.load((self.store / (name + ".npy")).as_posix(),
+                            mmap_mode="r")
+            self._arrays[name] = array
+            return array
+
+    def _window(self, roi):
+        """Converts a ROI in tile coordinates into slices of the store."""
+        ulx0, uly0, lrx0, lry0 = self.roi
+        if roi is None:
+            roi = self.roi
+        ulx, uly, lrx, lry = roi
+        if ulx < ulx0 or uly < uly0 or lrx > lrx0 or lry > lry0:
+            raise ValueError("ROI %s is outside the store ROI %s" %
+                             (roi, self.roi))
+        return slice(uly - uly0, lry - uly0), slice(ulx - ulx0, lrx - ulx0)
+
+    def _mask_qa(self, snow, qa, dtype):
+        mask = (snow == 0) & (qa <= 1)
+        qa_val = np.full(qa.shape, np.nan, dtype=dtype)
+        np.copyto(qa_val, qa, where=mask)
+        return mask, qa_val
+
+    def get_brdf_descriptors(self, band_no, date, roi=None,
+                             dtype=np.float32):
+        """Returns the kernels, mask and QA for a band and date, like
+        `RetrieveBRDFDescriptors.get_brdf_descriptors`, or None if the
+        date isn't in the store."""
+        try:
+            index = self._date_index[process_time_input(date)]
+        except KeyError:
+            return None
+        window = self._window(roi)
+        kernels = self._array("kernels_%s" % band_no)[
+            (index, slice(None)) + window].astype(dtype, copy=False)
+        mask, qa = self._mask_qa(self._array("snow")[(index,) + window],
+                                 self._array("qa_%s" % band_no)[
+                                     (index,) + window], dtype)
+        return kernels, mask, qa
+
+    def get_time_series(self, band_no, start_time=None, end_time=None,
+                        roi=None, dtype=np.float32):
+        """Returns the dates, and the (time, 3, y, x) kernels and
+        (time, y, x) mask and QA between `start_time` and `end_time`
+        (both inclusive). The kernels are a view into the store."""
+        start_time = self.dates[0] if start_time is None \
+            else process_time_input(start_time)
+        end_time = self.dates[-1] if end_time is None \
+            else process_time_input(end_time)
+        indices = [i for i, date in enumerate(self.dates)
+                   if start_time <= date <= end_time]
+        if len(indices) == 0:
+            raise ValueError("No dates between %s and %s" %
+                             (start_time, end_time))
+        times = slice(indices[0], indices[-1] + 1)
+        window = self._window(roi)
+        kernels = self._array("kernels_%s" % band_no)[
+            (times, slice(None)) + window].astype(dtype, copy=False)
+        mask, qa = self._mask_qa(self._array("snow")[(times,) + window],
+                                 self._array("qa_%s" % band_no)[
+                                     (times,) + window], dtype)
+        return self.dates[times], kernels, mask, qa
+
+    def contains(self, rows, cols):
+        """Returns True if all the pixels (in tile coordinates) are
+        within the store ROI."""
+        ulx0, uly0, lrx0, lry0 = self.roi
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        return bool(np.all((rows >= uly0) & (rows < lry0) &
+                           (cols >= ulx0) & (cols < lrx0)))
+
+    def get_pixel_time_series(self, band_no, row, col, dtype=np.float32):
+        """Returns the (time, 3) kernels, and the mask and QA time series
+        of a single pixel (in tile coordinates)."""
+        _, kernels, mask, qa = self.get_points_time_series(band_no, [row],
+                                                           [col],
+                                                           dtype=dtype)
+        return kernels[0], mask[0], qa[0]
+
+    def get_points_time_series(self, band_no, rows, cols, start_time=None,
+                               end_time=None, dtype=np.float32):
+        """Returns the dates, and the (n_points, time, 3) kernels and
+        (n_points, time) mask and QA of a set of pixels (in tile
+        coordinates) between `start_time` and `end_time` (both
+        inclusive). Only the pixels asked for are read from the store."""
+        rows = np.atleast_1d(rows).astype(int)
+        cols = np.atleast_1d(cols).astype(int)
+        if not self.contains(rows, cols):
+            raise ValueError("Some pixels are outside the store ROI %s" %
+                             (self.roi,))
+        start_time = self.dates[0] if start_time is None \
+            else process_time_input(start_time)
+        end_time = self.dates[-1] if end_time is None \
+            else process_time_input(end_time)
+        indices = [i for i, date in enumerate(self.dates)
+                   if start_time <= date <= end_time]
+        if len(indices) == 0:
+            raise ValueError("No dates between %s and %s" %
+                             (start_time, end_time))
+        times = slice(indices[0], indices[-1] + 1)
+        rows = rows - self.roi[1]
+        cols = cols - self.roi[0]
+        kernels = self._array("kernels_%s" % band_no)[
+            times, :, rows, cols].transpose(2, 0, 1).astype(dtype,
+                                                            copy=False)
+        mask, qa = self._mask_qa(self._array("snow")[times, rows, cols].T,
+                                 self._array("qa_%s" % band_no)[
+                                     times, rows, cols].T, dtype)
+        return self.dates[times], kernels, mask, qa
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""Benchmarks of granule discovery, reading and decoding, run against a
+synthetic MCD43 archive (see `synthetic.py`). Results are written as
+JSON, so that they can be compared between releases, e.g.
+
+    python benchmarks/run_benchmarks.py --size 2400 --days 16 \\
+        --output bench_output.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+sys.path.insert(0, myPath)
+
+import numpy as np
+import gdal
+
+import BRDF_descriptors
+from BRDF_descriptors import BRDF_descriptors as brdf
+from synthetic import NETCDF_TEMPLATE, make_archive
+
+
+def time_function(func, repeat=5, setup=None):
+    """Times `func` `repeat` times (calling `setup` before each run, out
+    of the timing). Returns a dictionary of statistics in seconds."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+    return {"min": min(timings), "median": float(np.median(timings)),
+            "mean": float(np.mean(timings)), "repeat": repeat}
+
+
+def run_benchmarks(archive, tile, n_days, size, start, repeat=5,
+                   n_threads=4, roi_size=256):
+    """Runs all the benchmarks on an archive made by `make_archive`.
+    Returns a dictionary of benchmark names and timings."""
+    a1_dir = os.path.join(archive, "MCD43A1")
+    a2_dir = os.path.join(archive, "MCD43A2")
+    end = start + datetime.timedelta(days=n_days - 1)
+    results = {}
+
+    def remove_index():
+        index_file = os.path.join(a1_dir, brdf.GRANULE_INDEX_NAME)
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+    # Discovery
+    remove_index()
+    results["find_granules_scan"] = time_function(
+        lambda: brdf.find_granules(a1_dir, tile, "A1", start, end,
+                                   use_index=False), repeat)
+    results["granule_index_build"] = time_function(
+        lambda: brdf.build_granule_index(a1_dir), repeat,
+        setup=remove_index)
+    results["find_granules_index"] = time_function(
+        lambda: brdf.find_granules(a1_dir, tile, "A1", start, end), repeat)
+    remove_index()
+
+    retriever = brdf.RetrieveBRDFDescriptors(tile, a1_dir, start,
+                                             end_time=end,
+                                             mcd43a2_dir=a2_dir)
+    a1_granule = retriever.a1_granules[start]
+    a2_granule = retriever.a2_granules[start]
+    roi = [0, 0, min(roi_size, size), min(roi_size, size)]
+    roi_retriever = brdf.RetrieveBRDFDescriptors(tile, a1_dir, start,
+                                                 end_time=end,
+                                                 mcd43a2_dir=a2_dir,
+                                                 roi=roi)
+
+    # Reading
+    snow_layer = brdf.granule_layer(a2_granule, "Snow_BRDF_Albedo")
+    results["open_gdal_dataset_full"] = time_function(
+        lambda: brdf.open_gdal_dataset(snow_layer), repeat)
+    results["open_gdal_dataset_roi"] = time_function(
+        lambda: brdf.open_gdal_dataset(snow_layer, roi), repeat)
+    results["process_masked_kernels_full"] = time_function(
+        lambda: brdf.process_masked_kernels(1, a1_granule, a2_granule),
+        repeat)
+    results["process_masked_kernels_roi"] = time_function(
+        lambda: brdf.process_masked_kernels(1, a1_granule, a2_granule,
+                                            roi=roi), repeat)
+    results["get_brdf_descriptors_full"] = time_function(
+        lambda: retriever.get_brdf_descriptors(1, start), repeat)
+    results["get_brdf_descriptors_roi"] = time_function(
+        lambda: roi_retriever.get_brdf_descriptors(1, start), repeat)
+    results["get_brdf_descriptors_multiband_full"] = time_function(
+        lambda: retriever.get_brdf_descriptors_multiband(
+            [1, 2, 3, 4, 5, 6, 7], start), repeat)
+    results["get_time_series_roi"] = time_function(
+        lambda: roi_retriever.get_time_series(1, n_threads=n_threads),
+        repeat)
+
+    # Decoding
+    raw = np.random.default_rng(0).integers(0, 1000, (3, size, size),
+                                            dtype=np.int16)
+    raw[:, :10, :10] = brdf.KERNEL_FILL
+    decode = time_function(lambda: brdf.process_kernels(raw), repeat)
+    decode["throughput_mb_s"] = raw.nbytes / 1e6 / decode["median"]
+    results["process_kernels_decode"] = decode
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="bench_output.json",
+                        help="JSON file to write the results to")
+    parser.add_argument("--workdir", default=None,
+                        help="Folder for the synthetic archive " +
+                        "(a temporary folder by default)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Don't delete the synthetic archive")
+    parser.add_argument("--tiles", nargs="+", default=["h17v05"],
+                        help="Tiles in the synthetic archive")
+    parser.add_argument("--days", type=int, default=8,
+                        help="Number of days in the synthetic archive")
+    parser.add_argument("--size", type=int, default=2400,
+                        help="Size of the synthetic granules (pixels)")
+    parser.add_argument("--roi-size", type=int, default=256,
+                        help="Size of the ROI reads (pixels)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of repetitions of each benchmark")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for time series reads")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="brdf_bench_")
+    start = datetime.datetime(2016, 1, 1)
+    template = brdf.SUBDATASET_TEMPLATE
+    brdf.SUBDATASET_TEMPLATE = NETCDF_TEMPLATE
+    try:
+        t0 = time.perf_counter()
+        make_archive(workdir, tiles=args.tiles, n_days=args.days,
+                     size=args.size, start=start)
+        setup_time = time.perf_counter() - t0
+        results = run_benchmarks(workdir, args.tiles[0], args.days,
+                                 args.size, start, repeat=args.repeat,
+                                 n_threads=args.threads,
+                                 roi_size=args.roi_size)
+    finally:
+        brdf.SUBDATASET_TEMPLATE = template
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"metadata": {
+                  "date": datetime.datetime.now().isoformat(),
+                  "version": BRDF_descriptors.__version__,
+                  "python": platform.python_version(),
+                  "numpy": np.__version__,
+                  "gdal": gdal.__version__,
+                  "platform": platform.platform(),
+                  "tiles": args.tiles, "days": args.days,
+                  "size": args.size, "roi_size": args.roi_size,
+                  "threads": args.threads,
+                  "archive_setup_s": setup_time},
+              "benchmarks": results}
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    for name, timing in results.items():
+        print("%-40s %10.4f s" % (name, timing["median"]))
+    print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
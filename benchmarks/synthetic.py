@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Synthetic MCD43A1/A2 granules for benchmarking.
+
+GDAL can't write HDF4-EOS files, so the granules are written as netCDF
+files (with the usual MCD43 file names), holding one variable per MCD43
+layer, named like the HDF subdatasets. Setting
+`BRDF_descriptors.BRDF_descriptors.SUBDATASET_TEMPLATE` to
+`NETCDF_TEMPLATE` makes the package read them as it would real
+granules.
+"""
+
+import datetime
+import os
+
+import numpy as np
+import gdal
+
+NETCDF_TEMPLATE = 'NETCDF:"%s":%s'
+
+BANDS = [1, 2, 3, 4, 5, 6, 7]
+BROADBANDS = ["vis", "nir", "shortwave"]
+
+
+def write_granule(fname, layers):
+    """Writes a dictionary of layer names and (y, x) or (3, y, x) arrays
+    into a netCDF file."""
+    drv = gdal.GetDriverByName("netCDF")
+    ds = drv.CreateMultiDimensional(fname)
+    root = ds.GetRootGroup()
+    shape = next(iter(layers.values())).shape[-2:]
+    dim_y = root.CreateDimension("y", None, None, shape[0])
+    dim_x = root.CreateDimension("x", None, None, shape[1])
+    dim_k = root.CreateDimension("kernel", None, None, 3)
+    for name, data in layers.items():
+        dims = [dim_y, dim_x] if data.ndim == 2 else [dim_k, dim_y, dim_x]
+        dtype = gdal.ExtendedDataType.Create(
+            {np.dtype(np.int16): gdal.GDT_Int16,
+             np.dtype(np.uint8): gdal.GDT_Byte}[data.dtype])
+        array = root.CreateMDArray(name, dims, dtype)
+        array.Write(data)
+    del ds
+
+
+def synthetic_layers(product, size, rng, fill_fraction=0.2,
+                     snow_fraction=0.1):
+    """Random layers for an A1 or A2 granule of `size` x `size` pixels."""
+    fill = rng.random((size, size)) < fill_fraction
+    layers = {}
+    if product == "A1":
+        for band in BANDS + BROADBANDS:
+            name = "Band%d" % band if band in BANDS else band
+            kernels = rng.integers(0, 1000, (3, size, size), dtype=np.int16)
+            kernels[:, fill] = 32767
+            layers["BRDF_Albedo_Parameters_%s" % name] = kernels
+            qa = rng.integers(0, 2, (size, size), dtype=np.uint8)
+            qa[fill] = 255
+            layers["BRDF_Albedo_Band_Mandatory_Quality_%s" % name] = qa
+    else:
+        snow = (rng.random((size, size)) < snow_fraction).astype(np.uint8)
+        snow[fill] = 255
+        layers["Snow_BRDF_Albedo"] = snow
+        layers["BRDF_Albedo_LandWaterType"] = rng.integers(
+            0, 8, (size, size), dtype=np.uint8)
+        unc = rng.integers(0, 1000, (size, size), dtype=np.int16)
+        unc[fill] = 32767
+        layers["BRDF_Albedo_Uncertainty"] = unc
+        for band in BANDS:
+            qa = rng.integers(0, 5, (size, size), dtype=np.uint8)
+            qa[fill] = 255
+            layers["BRDF_Albedo_Band_Quality_Band%d" % band] = qa
+    return layers
+
+
+def make_archive(root, tiles=("h17v05",), n_days=8, size=2400,
+                 start=datetime.datetime(2016, 1, 1), seed=42):
+    """Creates an archive of synthetic A1/A2 granules under `root`, laid
+    out as `<product>/<year>/<doy>/<granule>.hdf`. Returns the number of
+    granules written."""
+    rng = np.random.default_rng(seed)
+    n_granules = 0
+    for day in range(n_days):
+        date = start + datetime.timedelta(days=day)
+        for product in ["A1", "A2"]:
+            folder = os.path.join(root, "MCD43%s" % product,
+                                  date.strftime("%Y"), date.strftime("%j"))
+            os.makedirs(folder, exist_ok=True)
+            for tile in tiles:
+                fname = os.path.join(folder, "MCD43%s.A%s.%s.006.%s.hdf" %
+                                     (product, date.strftime("%Y%j"), tile,
+                                      "2017000000000"))
+                if os.path.exists(fname):
+                    continue
+                write_granule(fname, synthetic_layers(product, size, rng))
+                n_granules += 1
+    return n_granules
@@ -2,7 +2,7 @@
 import codecs
 import os
 import re
-from distutils.core import setup
+from setuptools import setup
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -28,4 +28,7 @@ setup(name='BRDF_descriptors',
       author_email='j.gomez-dans@ucl.ac.uk',
       url='https://github.com/jgomezdans/BRDF_descriptors',
       packages=['BRDF_descriptors']   ,
+      extras_require={'netcdf': ['netCDF4'], 'zarr': ['zarr']},
+      entry_points={'console_scripts': [
+          'mcd43_export = BRDF_descriptors.export:main']},
      )
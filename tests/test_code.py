@@ -5,6 +5,8 @@ myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 print (sys.path)
 import datetime
+import pathlib
+import zlib
 import numpy as np
 
 import pytest
@@ -12,7 +14,26 @@ from distutils import dir_util
 
 from BRDF_descriptors.BRDF_descriptors import process_time_input
 from BRDF_descriptors.BRDF_descriptors import find_granules
+from BRDF_descriptors.BRDF_descriptors import build_granule_index
 from BRDF_descriptors.BRDF_descriptors import RetrieveBRDFDescriptors
+from BRDF_descriptors.BRDF_descriptors import LayerCache
+from BRDF_descriptors.BRDF_descriptors import DatasetPool
+from BRDF_descriptors.BRDF_descriptors import group_pixels
+from BRDF_descriptors.BRDF_descriptors import process_kernels
+from BRDF_descriptors.BRDF_descriptors import pack_flags, flags_to_mask
+from BRDF_descriptors.BRDF_descriptors import flags_qa, flags_land
+from BRDF_descriptors.BRDF_descriptors import to_sparse, to_dense, stack_sparse
+from BRDF_descriptors.BRDF_descriptors import sparse_date
+from BRDF_descriptors import BRDF_descriptors as brdf
+from BRDF_descriptors import store as brdf_store
+from BRDF_descriptors.compositing import TemporalCompositor
+from BRDF_descriptors.instrument import instrument, PROBES
+from BRDF_descriptors.shared import SharedArrays, attach_shared
+from BRDF_descriptors.aio import AsyncBRDFService
+from BRDF_descriptors.export import NetCDFExport
+from BRDF_descriptors.sinusoidal import latlon_to_tile_pixel, sinusoidal_windows
+from BRDF_descriptors.kernels import kernel_values, predict_reflectance
+from BRDF_descriptors.albedo import black_sky_albedo, white_sky_albedo
 
 
 def test_time_string1():
@@ -43,7 +64,75 @@ def test_time_stringfail():
         test_string = "If I should fall from grace with god"
         retval = process_time_input ( test_string )
 
-def test_findgranules1(monkeypatch):
+def make_granules(folder, files):
+    """Creates empty granule files in `folder`, returning their paths."""
+    paths = []
+    for fich in files:
+        path = folder / os.path.basename(fich)
+        path.touch()
+        paths.append(path.as_posix())
+    return paths
+
+class FakeBand(object):
+    def __init__(self, data):
+        self.DataType = {np.dtype(np.uint8): brdf.gdal.GDT_Byte,
+                         np.dtype(np.int16): brdf.gdal.GDT_Int16}[data.dtype]
+
+    def GetBlockSize(self):
+        return [16, 8]
+
+class FakeDataset(object):
+    """Stands in for a GDAL dataset of a MCD43 layer, with random but
+    reproducible values for each (granule, layer)."""
+    def __init__(self, fname):
+        granule, layer = fname.split('"')[1], fname.split(":")[-1]
+        rng = np.random.default_rng(zlib.crc32(
+            (os.path.basename(granule) + layer).encode()))
+        if layer.startswith("BRDF_Albedo_Parameters"):
+            data = rng.integers(0, 800, (3, 32, 40)).astype(np.int16)
+            data[:, :2, :2] = 32767
+        elif layer == "Snow_BRDF_Albedo":
+            data = rng.integers(0, 2, (32, 40)).astype(np.uint8)
+        else:
+            data = rng.integers(0, 5, (32, 40)).astype(np.uint8)
+            data[:2, :2] = 255
+        self.data = data
+        self.RasterYSize, self.RasterXSize = data.shape[-2:]
+
+    def GetRasterBand(self, band):
+        return FakeBand(self.data)
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        xsize = self.RasterXSize if xsize is None else xsize
+        ysize = self.RasterYSize if ysize is None else ysize
+        return self.data[..., yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+@pytest.fixture
+def fake_archive(tmp_path, monkeypatch):
+    """Four days of empty h17v05 granules, read through a fake
+    `gdal.Open`."""
+    files = ["MCD43%s.A2017%03d.h17v05.006.1.hdf" % (product, doy)
+             for doy in range(1, 5) for product in ["A1", "A2"]]
+    make_granules(tmp_path, files)
+    monkeypatch.setattr(brdf.gdal, "Open", FakeDataset)
+    return tmp_path.as_posix()
+
+def baseline_descriptors(fname_a1, fname_a2, band_no, roi=None):
+    """The kernels, mask and QA of a band, decoded directly from the
+    fake datasets."""
+    layer = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_BRDF:%s'
+    window = (Ellipsis,) if roi is None else \
+        (Ellipsis, slice(roi[1], roi[3]), slice(roi[0], roi[2]))
+    kernels = FakeDataset(layer % (fname_a1, "BRDF_Albedo_Parameters_Band%d"
+                                   % band_no)).data[window]
+    snow = FakeDataset(layer % (fname_a2, "Snow_BRDF_Albedo")).data[window]
+    qa = FakeDataset(layer % (fname_a2, "BRDF_Albedo_Band_Quality_Band%d"
+                              % band_no)).data[window]
+    mask = (qa <= 1) & (snow == 0)
+    kernels = np.where(kernels == 32767, np.nan, kernels * 0.001)
+    return kernels, mask, np.where(mask, qa, np.nan)
+
+def test_findgranules1(tmp_path):
     #find_granules(dire, tile, product, start_time, end_time):
     files=['/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016001.h20v11.006.2016174080052.hdf',
            '/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016002.h20v11.006.2016174082609.hdf',
@@ -52,29 +141,620 @@ def test_findgranules1(monkeypatch):
            '/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016005.h20v11.006.2016174094032.hdf',
            '/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016006.h20v11.006.2016174100944.hdf']
 
-    monkeypatch.setattr("BRDF_descriptors.BRDF_descriptors.locate", lambda x, y:files)
-    granules = find_granules("/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/",
+    files = make_granules(tmp_path, files)
+    granules = find_granules(tmp_path.as_posix(),
                              "h20v11", "A2", datetime.datetime(2016,1,1),
                              None)
     assert set(granules.values()) == set(files)
 
-def test_findgranules2(monkeypatch):
+def test_findgranules2(tmp_path):
     #find_granules(dire, tile, product, start_time, end_time):
     files=[]
     with pytest.raises(IOError):
-        monkeypatch.setattr("BRDF_descriptors.BRDF_descriptors.locate", lambda x, y:files)
-        granules = find_granules("/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/",
+        make_granules(tmp_path, files)
+        granules = find_granules(tmp_path.as_posix(),
                                 "h20v11", "A2", datetime.datetime(2016,1,1),
                                 None)
 
-def test_findgranules3(monkeypatch):
+def test_findgranules3(tmp_path):
     #find_granules(dire, tile, product, start_time, end_time):
     files=['/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016001.h20v11.006.2016174080052.hdf',
            '/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016002.h20v11.006.2016174082609.hdf',
            '/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/MCD43A2.A2016003.h20v11.006.2016174085337.hdf']
-    monkeypatch.setattr("BRDF_descriptors.BRDF_descriptors.locate", lambda x, y:files)
-    granules = find_granules("/data/selene/ucfajlg/S2_AC/MCD43/Pretoria/",
+    files = make_granules(tmp_path, files)
+    granules = find_granules(tmp_path.as_posix(),
                                 "h20v11", "A2", datetime.datetime(2016,1,1),
                                 datetime.datetime(2016,1,3))
     assert set(granules.values()) == set(files)
 
+def test_granule_index(tmp_path):
+    for doy in ["001", "002", "003"]:
+        folder = tmp_path / "2016" / doy
+        folder.mkdir(parents=True)
+        for product in ["A1", "A2"]:
+            (folder / f"MCD43{product}.A2016{doy}.h20v11.006.1.hdf").touch()
+    build_granule_index(tmp_path.as_posix())
+    granules = find_granules(tmp_path.as_posix(), "h20v11", "A2",
+                             datetime.datetime(2016,1,2),
+                             datetime.datetime(2016,1,3))
+    assert sorted(granules.keys()) == [datetime.datetime(2016,1,2),
+                                       datetime.datetime(2016,1,3)]
+    # New granules are picked up by the next (incremental) update
+    (tmp_path / "2016" / "003" / "MCD43A2.A2016004.h20v11.006.1.hdf").touch()
+    granules = find_granules(tmp_path.as_posix(), "h20v11", "A2",
+                             datetime.datetime(2016,1,1), None)
+    assert len(granules) == 3
+    build_granule_index(tmp_path.as_posix())
+    granules = find_granules(tmp_path.as_posix(), "h20v11", "A2",
+                             datetime.datetime(2016,1,1), None)
+    assert len(granules) == 4
+    # Queries work on a read-only index
+    os.chmod(tmp_path / ".mcd43_granule_index.sqlite", 0o444)
+    try:
+        assert len(find_granules(tmp_path.as_posix(), "h20v11", "A1",
+                                 datetime.datetime(2016,1,1), None)) == 3
+    finally:
+        os.chmod(tmp_path / ".mcd43_granule_index.sqlite", 0o644)
+
+def test_granule_index_years(tmp_path):
+    for year, doy in [(2016, 335), (2016, 365), (2017, 1), (2018, 1)]:
+        folder = tmp_path / str(year)
+        folder.mkdir(exist_ok=True)
+        (folder / f"MCD43A1.A{year}{doy:03d}.h20v11.006.1.hdf").touch()
+    queries = [(datetime.datetime(2016,12,1), None),
+               (datetime.datetime(2016,12,5), datetime.datetime(2018,1,1)),
+               (datetime.datetime(2016,1,1), datetime.datetime(2016,12,30))]
+    scanned = [find_granules(tmp_path.as_posix(), "h20v11", "A1", start,
+                             end) for start, end in queries]
+    build_granule_index(tmp_path.as_posix())
+    indexed = [find_granules(tmp_path.as_posix(), "h20v11", "A1", start,
+                             end) for start, end in queries]
+    assert scanned == indexed
+    assert [len(granules) for granules in scanned] == [3, 3, 2]
+
+def test_granule_index_file(tmp_path):
+    archive = tmp_path / "archive"
+    for product in ["A1", "A2"]:
+        (archive / product).mkdir(parents=True)
+        for doy in ["001", "002"]:
+            (archive / product /
+             f"MCD43{product}.A2016{doy}.h20v11.006.1.hdf").touch()
+    # The index of the whole archive lives outside of it
+    index_file = (tmp_path / "index.sqlite").as_posix()
+    build_granule_index(archive.as_posix(), index_file=index_file)
+    for product in ["A1", "A2"]:
+        (archive / product /
+         f"MCD43{product}.A2016003.h20v11.006.1.hdf").touch()
+    retriever = RetrieveBRDFDescriptors("h20v11",
+                                        (archive / "A1").as_posix(),
+                                        "2016001",
+                                        mcd43a2_dir=(archive /
+                                                     "A2").as_posix(),
+                                        index_file=index_file)
+    assert len(retriever.a1_granules) == 2
+    assert all("/A2/" in granule
+               for granule in retriever.a2_granules.values())
+    assert not os.path.exists(archive / ".mcd43_granule_index.sqlite")
+    # Folders that aren't covered by the index are scanned
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "MCD43A1.A2016001.h20v11.006.1.hdf").touch()
+    assert len(find_granules(other.as_posix(), "h20v11", "A1",
+                             datetime.datetime(2016,1,1), None,
+                             index_file=index_file)) == 1
+
+def test_granule_index_symlinks(tmp_path):
+    folder = tmp_path / "2016"
+    folder.mkdir()
+    (folder / "MCD43A2.A2016001.h20v11.006.1.hdf").touch()
+    # Symlinked directories aren't followed, as with the folder scan
+    (folder / "loop").symlink_to(tmp_path)
+    build_granule_index(tmp_path.as_posix())
+    granules = find_granules(tmp_path.as_posix(), "h20v11", "A2",
+                             datetime.datetime(2016,1,1), None)
+    assert granules == find_granules(tmp_path.as_posix(), "h20v11", "A2",
+                                     datetime.datetime(2016,1,1), None,
+                                     use_index=False)
+    assert len(granules) == 1
+
+def test_layer_cache_eviction():
+    cache = LayerCache(max_bytes=250)
+    for i in range(3):
+        cache.put(("granule", "layer%d" % i, None), np.zeros(100, np.uint8))
+    assert cache.get(("granule", "layer0", None)) is None
+    assert cache.get(("granule", "layer2", None)) is not None
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["evictions"] == 1 and stats["nbytes"] == 200
+
+def test_group_pixels():
+    rows = np.array([1, 5, 100, 120])
+    cols = np.array([2, 10, 100, 90])
+    windows = dict(group_pixels(rows, cols, window_size=64))
+    assert set(windows.keys()) == {(2, 1, 11, 6), (90, 100, 101, 121)}
+
+def test_latlon_to_tile_pixel():
+    tiles, row, col = latlon_to_tile_pixel(51.5, -0.12)
+    assert tiles[0] == "h17v03"
+    assert (row, col) == (2040, 2382)
+
+def test_kernels_nadir():
+    k_vol, k_geo = kernel_values(0., 0., 0.)
+    assert np.allclose([k_vol, k_geo], [0., 0.])
+
+def test_predict_reflectance():
+    kernels = np.array([0.1, 0.05, 0.02])[None, :, None, None] * \
+        np.ones((2, 3, 4, 5))
+    sza = np.full((4, 5), 30.)
+    refl = predict_reflectance(kernels, (sza, 10., 90.))
+    k_vol, k_geo = kernel_values(sza, 10., 90.)
+    assert refl.shape == (2, 4, 5)
+    assert np.allclose(refl, 0.1 + 0.05*k_vol + 0.02*k_geo)
+
+def test_albedo():
+    kernels = np.ones((3, 4, 5))
+    mask = np.ones((4, 5), dtype=bool)
+    mask[0, 0] = False
+    wsa = white_sky_albedo(kernels, mask=mask, chunk_rows=3)
+    assert np.isnan(wsa[0, 0])
+    assert np.allclose(wsa[mask], 1. + 0.189184 - 1.377622)
+    # At nadir sun, BSA is just the polynomial constant terms
+    bsa = black_sky_albedo(kernels, 0.)
+    assert np.allclose(bsa, 1. - 0.007574 - 1.284909)
+
+def test_process_kernels():
+    raw = np.array([[[1000, 32767]], [[500, 0]], [[-20, 250]]],
+                   dtype=np.int16)
+    kernels = process_kernels(raw)
+    assert kernels.dtype == np.float32
+    assert np.isnan(kernels[0, 0, 1])
+    assert np.allclose(kernels[:, 0, 0], [1., 0.5, -0.02])
+    out = np.empty(raw.shape)
+    assert process_kernels(raw, out=out) is out
+    assert np.allclose(out, kernels, equal_nan=True)
+
+def test_pack_flags():
+    snow = np.array([True, True, False, True])
+    land = np.array([True, False, True, True])
+    qa = np.array([0, 1, 0, 255], dtype=np.uint8)
+    flags = pack_flags(snow, land, qa)
+    assert flags.dtype == np.uint8
+    assert np.all(flags_qa(flags) == [0, 1, 0, 7])
+    assert np.all(flags_land(flags) == land)
+    assert np.all(flags_to_mask(flags) == [True, True, False, False])
+    assert np.all(flags_to_mask(flags, land_only=True) ==
+                  [True, False, False, False])
+
+def test_sparse_roundtrip():
+    kernels = np.arange(24, dtype=np.float32).reshape((3, 2, 4))
+    mask = np.array([[True, False, False, True], [False] * 4])
+    qa = np.where(mask, 0., np.nan)
+    sparse = to_sparse(kernels, mask, qa)
+    assert sparse.kernels.shape == (2, 3)
+    dense_kernels, dense_mask, dense_qa = to_dense(sparse)
+    assert np.all(dense_mask == mask)
+    assert np.allclose(dense_kernels[:, mask], kernels[:, mask])
+    assert np.all(np.isnan(dense_kernels[:, ~mask]))
+    series = stack_sparse(["a", "b"], [sparse, to_sparse(kernels, ~mask, qa)])
+    assert list(series.offsets) == [0, 2, 8]
+    assert np.all(sparse_date(series, 1).index == np.flatnonzero(~mask))
+    # Raw kernels are filled with the fill value rather than 0
+    dense_kernels = to_dense(to_sparse(kernels.astype(np.int16), mask,
+                                       qa))[0]
+    assert np.all(dense_kernels[:, ~mask] == 32767)
+
+def test_temporal_compositor():
+    compositor = TemporalCompositor(window=2, stride=2)
+    mask = np.array([[True, False]])
+    qa = np.array([[0., np.nan]])
+    composites = []
+    for day, value in enumerate([1., 3., 5.]):
+        kernels = np.full((3, 1, 2), value)
+        composites += compositor.add(datetime.datetime(2016, 1, day + 1),
+                                     kernels, mask, qa)
+    composites += compositor.flush()
+    assert len(composites) == 2
+    assert np.allclose(composites[0].mean[:, 0, 0], 2.)
+    assert np.allclose(composites[0].variance[:, 0, 0], 1.)
+    assert np.all(np.isnan(composites[0].mean[:, 0, 1]))
+    assert composites[1].n_obs[0, 0] == 1
+
+def test_sinusoidal_windows():
+    # An extent straddling the four corners of h17v03, h18v03, h17v04
+    # and h18v04
+    tile_size = 1111950.5197665233
+    pixel = tile_size / 2400
+    x0 = -20015109.355797 + 18 * tile_size
+    y0 = 10007554.677899 - 4 * tile_size
+    origin, shape, windows = sinusoidal_windows(x0 - 10 * pixel,
+                                                y0 - 5 * pixel,
+                                                x0 + 20 * pixel,
+                                                y0 + 15 * pixel)
+    assert shape == (20, 30)
+    windows = {tile: (roi, offset) for tile, roi, offset in windows}
+    assert windows["h17v03"] == ((2390, 2385, 2400, 2400), (0, 0))
+    assert windows["h18v04"] == ((0, 0, 20, 5), (15, 10))
+
+
+
+def test_mosaic(fake_archive, monkeypatch):
+    import functools
+    from BRDF_descriptors import mosaic as brdf_mosaic
+    from BRDF_descriptors.mosaic import MosaicBRDFDescriptors
+    from BRDF_descriptors import sinusoidal
+    # Tiles of 32 by 32 pixels, read from the top left of the fake data
+    windows = functools.partial(sinusoidal.polygon_windows, n_pixels=32)
+    monkeypatch.setattr(brdf_mosaic, "polygon_windows", windows)
+    monkeypatch.setattr(brdf_mosaic, "pixel_geotransform",
+                        functools.partial(sinusoidal.pixel_geotransform,
+                                          n_pixels=32))
+    make_granules(pathlib.Path(fake_archive),
+                  ["MCD43%s.A2017%03d.h18v05.006.1.hdf" % (product, doy)
+                   for doy in (2, 3) for product in ["A1", "A2"]])
+    # A box across h17v05 and h18v05, and a triangle that also covers
+    # h17v06 and h18v06, which have no granules
+    bbox = (-1., 33., 1., 37.)
+    triangle = [(-1., 25.), (1., 25.), (0., 37.)]
+    for kwargs in [{"bbox": bbox}, {"polygon": triangle}]:
+        mosaic = MosaicBRDFDescriptors(fake_archive, "2017001", **kwargs)
+        assert mosaic.dates == [datetime.datetime(2017, 1, 2),
+                                datetime.datetime(2017, 1, 3)]
+        assert sorted(retriever.tile for retriever, _ in mosaic.tiles) == \
+            ["h17v05", "h18v05"]
+        assert mosaic.get_brdf_descriptors(1, "2017001") is None
+        kernels, mask, qa = mosaic.get_brdf_descriptors(2, "2017003")
+        inside = np.ones(mask.shape, dtype=bool) if mosaic.inside is None \
+            else mosaic.inside
+        covered = np.zeros(mask.shape, dtype=bool)
+        polygon = triangle if "polygon" in kwargs else \
+            sinusoidal.bbox_to_polygon(*bbox)
+        for tile, roi, (row, col) in windows(polygon)[2]:
+            window = (slice(row, row + roi[3] - roi[1]),
+                      slice(col, col + roi[2] - roi[0]))
+            if tile.endswith("v06"):
+                continue
+            covered[window] = True
+            fname = os.path.join(fake_archive,
+                                 "MCD43%s.A2017003.%s.006.1.hdf")
+            expected = baseline_descriptors(fname % ("A1", tile),
+                                            fname % ("A2", tile), 2,
+                                            roi=roi)
+            for a, b in zip(expected, (kernels, mask, qa)):
+                a = np.where(inside[window], a, np.nan if a.dtype.kind ==
+                             "f" else False)
+                assert np.allclose(a, b[..., window[0], window[1]],
+                                   equal_nan=True)
+        assert covered.all() == ("bbox" in kwargs)
+        assert not mask[~(covered & inside)].any()
+        assert np.isnan(kernels[:, ~(covered & inside)]).all()
+        if "polygon" in kwargs:
+            assert inside.any() and not inside.all()
+            assert mask[covered & inside].any()
+
+
+def test_instrument():
+    raw = np.array([[[1000, 32767]]] * 3, dtype=np.int16)
+    events = []
+    with instrument(callback=lambda *event: events.append(event)) as profile:
+        process_kernels(raw)
+    process_kernels(raw)
+    report = profile.report()
+    assert len(PROBES) == 0
+    assert len(events) == 1 and events[0][0] == "decode"
+    assert report["stages"]["decode"]["calls"] == 1
+    assert report["arrays_allocated"] == 1
+
+
+def test_shared_arrays():
+    with SharedArrays() as shared:
+        data, descriptor = shared.empty((3, 4, 5), np.float32)
+        data[:] = np.arange(60).reshape(3, 4, 5)
+        attached = attach_shared(descriptor)
+        assert attached.dtype == np.float32
+        assert np.array_equal(attached, data)
+        attached[0, 0, 0] = -1.
+        assert data[0, 0, 0] == -1.
+    assert len(shared) == 0
+
+
+def _read_shared(descriptors):
+    """Copies shared arrays out in a worker process."""
+    return tuple(np.array(data) for data in attach_shared(descriptors))
+
+
+def test_shared_descriptors(fake_archive):
+    from concurrent.futures import ProcessPoolExecutor
+    from BRDF_descriptors.shared import SharedArray
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        roi=[4, 2, 30, 20])
+    expected = retriever.get_brdf_descriptors(1, "2017003")
+    with SharedArrays() as shared:
+        descriptors = retriever.get_brdf_descriptors(1, "2017003",
+                                                     shared=shared)
+        assert all(isinstance(descriptor, SharedArray)
+                   for descriptor in descriptors)
+        assert len(shared) == 3
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(_read_shared, [descriptors] * 2))
+    for result in results:
+        for a, b in zip(expected, result):
+            assert a.dtype == b.dtype and a.shape == b.shape
+            assert np.allclose(a, b, equal_nan=True)
+
+
+def test_async_service_coalescing():
+    import asyncio
+    import threading
+
+    class SlowRetriever(object):
+        def __init__(self):
+            self.calls = 0
+            self.event = threading.Event()
+
+        def get_brdf_descriptors(self, band_no, date, raw=False):
+            self.calls += 1
+            self.event.wait(5)
+            return np.full(3, band_no), np.ones(3, dtype=bool), np.zeros(3)
+
+    retriever = SlowRetriever()
+
+    async def run():
+        async with AsyncBRDFService(retriever, max_concurrency=2) as service:
+            requests = [service.get_brdf_descriptors(band, "2017-01-01")
+                        for band in [1, 1, 1, 2, 2]]
+            tasks = asyncio.gather(*requests)
+            await asyncio.sleep(0.05)
+            retriever.event.set()
+            return await tasks, service.stats()
+
+    results, stats = asyncio.run(run())
+    assert retriever.calls == 2
+    assert stats["coalesced"] == 3 and stats["in_flight"] == 0
+    assert results[0][0] is results[2][0]
+    assert not results[0][0].flags.writeable
+    assert results[3][0][0] == 2
+
+
+def test_async_service_shared_layers(fake_archive, monkeypatch):
+    import asyncio
+    import threading
+    import time
+    opened = []
+    lock = threading.Lock()
+
+    def slow_open(fname):
+        with lock:
+            opened.append(fname.split(":")[-1])
+        time.sleep(0.05)
+        return FakeDataset(fname)
+
+    monkeypatch.setattr(brdf.gdal, "Open", slow_open)
+    cache = LayerCache()
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        cache=cache)
+
+    async def run():
+        async with AsyncBRDFService(retriever, max_concurrency=3) as service:
+            return await asyncio.gather(
+                *[service.get_brdf_descriptors(band, "2017002")
+                  for band in [1, 2, 3]])
+
+    results = asyncio.run(run())
+    # The snow mask is read once for the three bands
+    assert opened.count("Snow_BRDF_Albedo") == 1 and len(opened) == 7
+    assert cache.stats()["coalesced"] == 2
+    date = datetime.datetime(2017, 1, 2)
+    for band_no, result in zip([1, 2, 3], results):
+        expected = baseline_descriptors(retriever.a1_granules[date],
+                                        retriever.a2_granules[date],
+                                        band_no)
+        for a, b in zip(expected, result):
+            assert np.allclose(a, b, equal_nan=True)
+
+
+def test_netcdf_export_resume(tmp_path):
+    pytest.importorskip("netCDF4")
+    fname = (tmp_path / "export.nc").as_posix()
+    import netCDF4
+    kernels = np.arange(3 * 4 * 10, dtype=np.int16).reshape(1, 3, 4, 10) * 7
+    mask = np.zeros((1, 4, 2), dtype=np.uint8)
+    qa = np.zeros((1, 4, 10), dtype=np.uint8)
+    writer = NetCDFExport(fname, [1], (4, 10), chunk_time=2)
+    for day in range(1, 4):
+        writer.append(datetime.datetime(2017, 1, day), kernels, mask, qa)
+    writer.close()
+    writer = NetCDFExport(fname, [1], (4, 10), chunk_time=2)
+    assert writer.dates == [datetime.datetime(2017, 1, day)
+                            for day in range(1, 4)]
+    writer.append(datetime.datetime(2017, 1, 4), kernels, mask, qa)
+    writer.close()
+    ds = netCDF4.Dataset(fname)
+    ds.set_auto_maskandscale(False)
+    stored = ds["kernels_1"][:]
+    ds.close()
+    assert stored.shape == (4, 3, 4, 10)
+    assert np.array_equal(stored, np.repeat(kernels, 4, axis=0))
+
+
+def test_pixel_time_series_store(fake_archive, tmp_path):
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        roi=[10, 8, 30, 24])
+    store_dir = (tmp_path / "store").as_posix()
+    brdf_store.convert_to_store(store_dir, retriever, bands=[1])
+    hdf = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001")
+    stored = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                     store_dir=store_dir)
+    # The second set of pixels isn't all within the store ROI
+    for rows, cols in [([8, 20, 23], [10, 15, 29]), ([20, 2], [15, 5])]:
+        expected = hdf.get_pixel_time_series(1, rows, cols)
+        result = stored.get_pixel_time_series(1, rows, cols)
+        for a, b in zip(expected[1:], result[1:]):
+            assert np.allclose(a, b, equal_nan=True)
+
+
+def test_pixel_time_series_outside(fake_archive):
+    from BRDF_descriptors.sinusoidal import sinusoidal_to_latlon
+    from BRDF_descriptors.sinusoidal import tile_geotransform
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001")
+    # Centres of pixels (5, 7), (-3, 7) (in h17v04) and (5, 45)
+    x0, dx, _, y0, _, dy = tile_geotransform("h17v05")
+    lat, lon = sinusoidal_to_latlon(x0 + np.array([7.5, 7.5, 45.5]) * dx,
+                                    y0 + np.array([5.5, -2.5, 5.5]) * dy)
+    dates, kernels, _, _ = retriever.get_pixel_time_series(
+        1, lat[:1], lon[:1], latlon=True)
+    expected = retriever.get_pixel_time_series(1, [5], [7])[1]
+    assert np.allclose(kernels, expected, equal_nan=True)
+    with pytest.raises(ValueError) as excinfo:
+        retriever.get_pixel_time_series(1, lat, lon, latlon=True)
+    assert "%s" % lat[1] in str(excinfo.value)
+    assert "%s" % lon[2] in str(excinfo.value)
+    assert "%s" % lon[0] not in str(excinfo.value)
+    with pytest.raises(ValueError):
+        retriever.get_pixel_time_series(1, [5, -1], [7, 7])
+
+def test_store_roundtrip(fake_archive, tmp_path):
+    store_dir = (tmp_path / "store").as_posix()
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        roi=[10, 8, 30, 24])
+    brdf_store.convert_to_store(store_dir, retriever, bands=[1, 2])
+    # The second ROI isn't covered by the store, so it's read from HDF
+    for roi in [[12, 10, 20, 24], [0, 0, 20, 20], None]:
+        for dtype in [np.float32, np.float64]:
+            hdf = RetrieveBRDFDescriptors("h17v05", fake_archive,
+                                          "2017001", roi=roi, dtype=dtype)
+            stored = RetrieveBRDFDescriptors("h17v05", fake_archive,
+                                             "2017001", roi=roi,
+                                             store_dir=store_dir,
+                                             dtype=dtype)
+            assert stored.store is not None
+            assert stored._in_store(2, [datetime.datetime(2017, 1, 2)]) \
+                == (roi == [12, 10, 20, 24])
+            for a, b in zip(hdf.get_brdf_descriptors(2, "2017002"),
+                            stored.get_brdf_descriptors(2, "2017002")):
+                assert a.dtype == b.dtype
+                assert np.allclose(a, b, equal_nan=True)
+            for a, b in zip(hdf.get_time_series(1)[1:],
+                            stored.get_time_series(1)[1:]):
+                assert a.dtype == b.dtype
+                assert np.allclose(a, b, equal_nan=True)
+    # float32 kernels are read straight from the store
+    stored = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                     roi=[12, 10, 20, 24],
+                                     store_dir=store_dir)
+    assert np.shares_memory(stored.get_brdf_descriptors(2, "2017002")[0],
+                            stored.store._array("kernels_2"))
+
+def test_kernel_memo_bounded(monkeypatch):
+    from BRDF_descriptors import kernels as brdf_kernels
+    brdf_kernels.clear_memo()
+    sza = np.linspace(0., 60., 1000)
+    # Room for the kernels of two geometries only
+    monkeypatch.setattr(brdf_kernels, "MEMO_BYTES", 2 * 2 * sza.nbytes)
+    first = kernel_values(sza, 10., 0.)
+    assert kernel_values(sza, 10., 0.)[0] is first[0]
+    kernel_values(sza, 20., 0.)
+    kernel_values(sza, 30., 0.)
+    assert len(brdf_kernels._memo) == 2
+    assert kernel_values(sza, 10., 0.)[0] is not first[0]
+    brdf_kernels.clear_memo()
+
+def test_multiband_descriptors(fake_archive):
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        roi=[5, 3, 25, 30])
+    date = datetime.datetime(2017, 1, 3)
+    kernels, mask, qa = retriever.get_brdf_descriptors_multiband([1, 4, 7],
+                                                                 date)
+    assert kernels.shape == (3, 3, 27, 20) and mask.shape == (3, 27, 20)
+    for i, band_no in enumerate([1, 4, 7]):
+        expected = baseline_descriptors(retriever.a1_granules[date],
+                                        retriever.a2_granules[date],
+                                        band_no, roi=[5, 3, 25, 30])
+        for a, b in zip(expected, (kernels[i], mask[i], qa[i])):
+            assert np.allclose(a, b, equal_nan=True)
+
+def test_time_series(fake_archive):
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001")
+    dates, kernels, mask, qa = retriever.get_time_series(
+        2, "2017002", "2017004", n_threads=2)
+    assert dates == [datetime.datetime(2017, 1, day) for day in (2, 3, 4)]
+    assert kernels.shape == (3, 3, 32, 40) and kernels.dtype == np.float32
+    for i, date in enumerate(dates):
+        expected = baseline_descriptors(retriever.a1_granules[date],
+                                        retriever.a2_granules[date], 2)
+        for a, b in zip(expected, (kernels[i], mask[i], qa[i])):
+            assert np.allclose(a, b, equal_nan=True)
+    with pytest.raises(ValueError):
+        retriever.get_time_series(2, "2017010")
+
+def test_iter_descriptors(fake_archive, monkeypatch):
+    import threading
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001")
+    dates = ["2017004", "2017002", "2017010", "2017003"]
+    items = list(retriever.iter_descriptors(1, dates, prefetch=1))
+    # Dates come back in the order asked for, skipping missing ones
+    assert [item[0].day for item in items] == [4, 2, 3]
+    kernels = retriever.get_brdf_descriptors(1, "2017002")[0]
+    assert np.allclose(items[1][1], kernels, equal_nan=True)
+    # Closing the iterator early stops the reader thread
+    n_threads = threading.active_count()
+    iterator = retriever.iter_descriptors(1, prefetch=1)
+    next(iterator)
+    iterator.close()
+    assert threading.active_count() == n_threads
+    # Reading errors are raised by the iterator
+
+    def failing(band_no, date):
+        if date.day == 3:
+            raise IOError("Broken granule")
+        return kernels, None, None
+
+    monkeypatch.setattr(retriever, "get_brdf_descriptors", failing)
+    iterator = retriever.iter_descriptors(1)
+    assert next(iterator)[0].day == 1
+    assert next(iterator)[0].day == 2
+    with pytest.raises(IOError):
+        next(iterator)
+
+def test_dataset_pool(fake_archive):
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        pool=DatasetPool(max_open=3),
+                                        roi=[0, 0, 10, 10])
+    expected = retriever.get_brdf_descriptors(1, "2017001")
+    # Snow, kernels and QA layers
+    assert retriever.pool.stats()["opens"] == 3
+    retriever.roi = [10, 10, 20, 20]
+    retriever.get_brdf_descriptors(1, "2017001")
+    stats = retriever.pool.stats()
+    assert stats["opens"] == 3 and stats["opens_avoided"] == 3
+    retriever.roi = [0, 0, 10, 10]
+    for a, b in zip(expected, retriever.get_brdf_descriptors(1, "2017001")):
+        assert np.allclose(a, b, equal_nan=True)
+    # The least recently used handles are closed
+    pool = DatasetPool(max_open=1)
+    snow = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_BRDF:Snow_BRDF_Albedo'
+    for day in [1, 2, 2, 1]:
+        pool.open(snow % retriever.a2_granules[datetime.datetime(2017, 1,
+                                                                 day)])
+    assert pool.stats()["opens"] == 3 and pool.stats()["opens_avoided"] == 1
+
+def test_tiled_descriptors(fake_archive):
+    retriever = RetrieveBRDFDescriptors("h17v05", fake_archive, "2017001",
+                                        roi=[3, 5, 37, 30])
+    expected = retriever.get_brdf_descriptors(3, "2017002")
+    # Blocks are rounded up to the (16, 8) chunks of the fake datasets
+    result = retriever.get_brdf_descriptors_tiled(3, "2017002",
+                                                  block_size=10,
+                                                  n_workers=2)
+    for a, b in zip(expected, result):
+        assert a.shape == b.shape
+        assert np.allclose(a, b, equal_nan=True)
+
+def test_instrument_granules(fake_archive):
+    with instrument() as profile:
+        retriever = RetrieveBRDFDescriptors("h17v05", fake_archive,
+                                            "2017001")
+        retriever.get_brdf_descriptors(1, "2017002")
+    report = profile.report()
+    assert report["stages"]["scan"]["calls"] == 2
+    assert report["n_granules"] == 2
+    assert all(granule.endswith(".hdf") for granule in report["granules"])